@@ -0,0 +1,104 @@
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from recsys.ap_recsys import ApRecsys
+from recsys.serve.redis_client import RedisConnectionConfig, RedisClient
+from recsys.train.mongo_client import MongoConfig
+
+
+def load_progress(progress_path):
+    if not os.path.exists(progress_path):
+        return 0
+
+    with open(progress_path, 'r') as f:
+        return json.load(f)['next_user_index']
+
+
+def save_progress(progress_path, next_user_index):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'next_user_index': next_user_index, 'timestamp': int(time.time())}, f)
+    os.replace(tmp_path, progress_path)
+
+
+def score_users(ap_model, histories, top_k):
+    user_indices = [user_index for user_index, history in histories.items() if len(history) > 0]
+    if len(user_indices) == 0:
+        return dict()
+
+    input = ap_model.get_serve_input([histories[user_index] for user_index in user_indices])
+    item_index, _ = ap_model.recommend(input, top_k)
+
+    recommendations = dict()
+    for user_index, row in zip(user_indices, item_index):
+        recommendations[f'ap_mall_rec:{user_index}'] = ap_model.to_itemId(row[row >= 0])
+
+    return recommendations
+
+
+def batch_inference(ap_model, redis_client, progress_path, top_k=20, batch_size=10000, num_workers=4,
+                    expire_time_seconds=None, restart=False):
+    """ score every user and write the top_k itemIds to redis, resuming from progress_path unless restart"""
+    start = 0 if restart else load_progress(progress_path)
+    total_users = ap_model.total_users
+    print(f'batch inference from user {start} to {total_users}')
+
+    pending = deque()
+    completed = start
+    begin = time.time()
+
+    with ThreadPoolExecutor(max_workers=num_workers) as writers:
+        for batch_start in range(start, total_users, batch_size):
+            batch_stop = min(batch_start + batch_size, total_users)
+
+            histories = ap_model.get_histories(batch_start, batch_stop)
+            recommendations = score_users(ap_model, histories, top_k)
+            pending.append((batch_stop, writers.submit(redis_client.set_recommendations,
+                                                       recommendations, expire_time_seconds)))
+
+            # only checkpoint the prefix of batches whose writes have all finished
+            while len(pending) > 0 and (pending[0][1].done() or len(pending) > num_workers):
+                written_stop, future = pending.popleft()
+                future.result()
+                completed = written_stop
+                save_progress(progress_path, completed)
+
+            elapsed = time.time() - begin
+            print(f'[{batch_stop}/{total_users}] {(batch_stop - start) / elapsed:.1f} users/sec')
+
+        while len(pending) > 0:
+            written_stop, future = pending.popleft()
+            future.result()
+            completed = written_stop
+            save_progress(progress_path, completed)
+
+    return completed
+
+
+def main():
+    mongo_config = MongoConfig(host='13.209.6.203',
+                               username='romi',
+                               password="Amore12345!",
+                               dbname='recsys_apmall')
+
+    model_save_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_save')
+
+    ap_model = ApRecsys(model_save_path, mongo_config)
+    ap_model.use_history_store()
+    ap_model.build_serve_model()
+    ap_model.restore(restore_serve=True)
+
+    redis_config = RedisConnectionConfig()
+    redis_client = RedisClient(redis_connection_config=redis_config,
+                               max_seq_len=ap_model.max_seq_len,
+                               expire_time_seconds=None)
+
+    progress_path = os.path.join(model_save_path, 'batch_inference_progress.json')
+    batch_inference(ap_model, redis_client, progress_path)
+
+
+if __name__ == '__main__':
+    main()
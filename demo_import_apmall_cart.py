@@ -1,12 +1,18 @@
+import os
 import csv
-from collections import defaultdict
-from datetime import datetime
+import time
+import shutil
+import tempfile
+import itertools
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 
 import pymongo
 
+from recsys.train.history_store import HistoryStore
+from recsys.train.item_index import ItemIndex
+
 
 def save(filename, list_values):
     if not isinstance(list_values, list):
@@ -16,10 +22,6 @@ def save(filename, list_values):
     np.save(filename, list_values)
 
 
-def load(filename):
-    return np.load(filename)
-
-
 def draw_hist(items, step=1000):
 
     values = [item['count'] for item in items]
@@ -39,97 +41,266 @@ def draw_hist(items, step=1000):
     plt.show()
 
 
-def add_cart_data_from_csv(recsys_db):
-    recsys_db.users.delete_many({})
-    recsys_db.items.delete_many({})
+_event_dtype = np.dtype([('userId', np.int64),
+                         ('timestamp', np.int64),
+                         ('row', np.int64),
+                         ('item_index', np.int32),
+                         ('purchased', np.bool_)])
 
-    users = dict()
-    items = dict()
 
-    with open('./apmall_cart_hist_nm.csv', 'r') as f:
-        _ = f.readline()
+def parse_timestamps(values):
+    """ vectorized '%Y%m%d%H%M%S' (local time) to unix timestamp"""
+    values = np.asarray(values, dtype=np.int64)
 
-        for cols in csv.reader(f, delimiter=','):
-            try:
-                comcsno = int(cols[0].strip())
-                tmp = cols[2].strip()
-                insert_time = int(datetime.strptime(tmp, '%Y%m%d%H%M%S').timestamp())
-                itemId = cols[3].strip()
-                sap_code = cols[4].strip()
-                buy_flag = True if cols[5].strip() == 'Y' else False
-                itemName = cols[6].strip()
-
-                if not comcsno in users:
-                    user = {
-                        'userId': comcsno,
-                        'itemIds': []
-                    }
+    seconds = values % 100
+    minutes = values // 100 % 100
+    hours = values // 10000 % 100
+    days = values // 1000000 % 100
+    months = values // 100000000 % 100
+    years = values // 10000000000
 
-                    users[comcsno] = user
-
-                users[comcsno]['itemIds'].append({
-                    'itemId': itemId,
-                    'purchased': buy_flag,
-                    'timestamp': insert_time
-                })
-
-                if not itemId in items:
-                    item = {
-                        'itemId': itemId,
-                        'sap_code': sap_code,
-                        'itemName': itemName,
-                        'url': "",
-                        'count': 0
-                    }
+    dates = (years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months - 1)
+    dates = dates.astype('datetime64[D]') + (days - 1)
+    utc_seconds = dates.astype('datetime64[s]').astype(np.int64) + hours * 3600 + minutes * 60 + seconds
+
+    # the timestamps are local time, time.timezone is the offset from local time to UTC
+    return utc_seconds + time.timezone
 
-                    items[itemId] = item
 
-                items[itemId]['count'] = items[itemId]['count'] + 1
+def read_csv_chunks(csv_path, chunk_size):
+    with open(csv_path, 'r') as f:
+        _ = f.readline()
 
-            except Exception as e:
-                print(f'Exception: {str(e)}')
+        reader = csv.reader(f, delimiter=',')
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if len(rows) == 0:
                 return
 
-    user_idx = 0
-    users_to_delete = []
-    for user in users.values():
+            yield rows
+
+
+def parse_chunk(rows, first_row, items):
+    """ returns the chunk as an _event_dtype array, new items are added to items"""
+    cols = list(zip(*rows))
+
+    itemIds = [itemId.strip() for itemId in cols[3]]
+    item_indices = np.empty(len(rows), dtype=np.int32)
+    for ind, itemId in enumerate(itemIds):
+        item = items.get(itemId)
+        if item is None:
+            item = {
+                'itemId': itemId,
+                'sap_code': cols[4][ind].strip(),
+                'itemName': cols[6][ind].strip(),
+                'url': "",
+                'count': 0,
+                'item_index': len(items)
+            }
+            items[itemId] = item
+
+        item['count'] += 1
+        item_indices[ind] = item['item_index']
+
+    events = np.zeros(len(rows), dtype=_event_dtype)
+    events['userId'] = np.array(cols[0], dtype=np.int64)
+    events['timestamp'] = parse_timestamps(np.char.strip(np.array(cols[2])))
+    events['row'] = np.arange(first_row, first_row + len(rows))
+    events['item_index'] = item_indices
+    events['purchased'] = np.char.strip(np.array(cols[5])) == 'Y'
+
+    return events
+
+
+def partition_events(csv_path, partition_dir, num_partitions, chunk_size, items):
+    """ first pass of the external sort: spill events to partition files by userId"""
+    partition_files = [open(os.path.join(partition_dir, f'part_{ind}.bin'), 'wb') for ind in range(num_partitions)]
+
+    total_rows = 0
+    start = time.time()
+    try:
+        for rows in read_csv_chunks(csv_path, chunk_size):
+            events = parse_chunk(rows, total_rows, items)
+            total_rows += len(events)
+
+            partitions = events['userId'] % num_partitions
+            order = np.argsort(partitions, kind='stable')
+            bounds = np.searchsorted(partitions[order], np.arange(num_partitions + 1))
+            for ind in range(num_partitions):
+                events[order[bounds[ind]:bounds[ind + 1]]].tofile(partition_files[ind])
+
+            print(f'parsed {total_rows} rows ({total_rows / (time.time() - start):.0f} rows/sec)')
+    finally:
+        for f in partition_files:
+            f.close()
+
+    return total_rows
+
+
+def iter_user_docs(partition_path, index_to_itemId, min_items=2):
+    """ second pass: sort one partition by (userId, timestamp, row) and group it into user documents"""
+    events = np.fromfile(partition_path, dtype=_event_dtype)
+    if len(events) == 0:
+        return
 
-        if len(user['itemIds']) < 2:
-            users_to_delete.append(user['userId'])
+    events = events[np.lexsort((events['row'], events['timestamp'], events['userId']))]
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(events['userId'])) + 1, [len(events)]])
+
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop - start < min_items:
             continue
 
-        user['itemIds'].sort(key=lambda elem: int(elem['timestamp']))
-        user['sorted_items'] = [elem['itemId'] for elem in user['itemIds']]
-        user['user_index'] = user_idx
-        user_idx += 1
+        user_events = events[start:stop]
+        sorted_items = [index_to_itemId[item_index] for item_index in user_events['item_index']]
 
-    for userId in users_to_delete:
-        users.pop(userId)
+        yield {
+            'userId': int(user_events['userId'][0]),
+            'itemIds': [{'itemId': itemId, 'purchased': bool(purchased), 'timestamp': int(timestamp)}
+                        for itemId, purchased, timestamp in zip(sorted_items,
+                                                                user_events['purchased'],
+                                                                user_events['timestamp'])],
+            'sorted_items': sorted_items
+        }
 
-    users = list(users.values())
-    items = list(items.values())
 
-    for idx, item in enumerate(items):
-        item['item_index'] = idx
+def add_cart_data_from_csv(recsys_db, csv_path='./apmall_cart_hist_nm.csv', chunk_size=500000,
+                           num_partitions=64, insert_batch_size=10000, model_dir=None):
+    recsys_db.users.delete_many({})
+    recsys_db.items.delete_many({})
+
+    items = dict()
+
+    partition_dir = tempfile.mkdtemp(prefix='apmall_cart_')
+    try:
+        try:
+            total_rows = partition_events(csv_path, partition_dir, num_partitions, chunk_size, items)
+        except Exception as e:
+            print(f'Exception: {str(e)}')
+            return
+
+        index_to_itemId = [None] * len(items)
+        for item in items.values():
+            index_to_itemId[item['item_index']] = item['itemId']
+
+        user_idx = 0
+        users = []
+        start = time.time()
+        for ind in range(num_partitions):
+            for user in iter_user_docs(os.path.join(partition_dir, f'part_{ind}.bin'), index_to_itemId):
+                user['user_index'] = user_idx
+                user_idx += 1
+                users.append(user)
+
+                if len(users) == insert_batch_size:
+                    recsys_db.users.insert_many(users, ordered=False)
+                    users = []
+                    print(f'inserted {user_idx} users ({user_idx / (time.time() - start):.0f} users/sec)')
+
+        if len(users) > 0:
+            recsys_db.users.insert_many(users, ordered=False)
+
+        print(f'inserted {user_idx} users from {total_rows} rows in {time.time() - start:.0f} sec')
+    finally:
+        shutil.rmtree(partition_dir)
 
-    save('records', users)
+    items = list(items.values())
     save('items', items)
 
-    recsys_db.users.insert_many(users)
-    recsys_db.items.insert_many(items)
+    for start in range(0, len(items), insert_batch_size):
+        recsys_db.items.insert_many(items[start:start + insert_batch_size], ordered=False)
 
+    # serving does not compare the persisted artifacts with mongodb at startup, they have to be marked stale here
+    if model_dir is not None:
+        HistoryStore.invalidate(os.path.join(model_dir, 'history_store'))
+        ItemIndex.invalidate(os.path.join(model_dir, 'item_index'))
 
-def add_cart_data_from_file(recsys_db):
-    recsys_db.users.delete_many({})
-    recsys_db.items.delete_many({})
 
-    records = load('records.npy')
-    items = load('items.npy')
+def add_cart_data_incremental(recsys_db, csv_path, chunk_size=500000, num_partitions=64, write_batch_size=10000,
+                              model_dir=None):
+    """ append new cart events to existing users, keeping item_index and user_index of known ids stable
+
+    events are assumed to be newer than what is already stored for a user. the item index and the history store
+    persisted in model_dir are marked stale afterwards, so training and serving rebuild them on their next start.
+    """
+    recsys_db.users.create_index('userId')
+    recsys_db.items.create_index('itemId')
+
+    items = dict()
+    for doc in recsys_db.items.find({}, {'_id': 0, 'itemId': 1, 'item_index': 1}):
+        items[doc['itemId']] = {'itemId': doc['itemId'], 'item_index': doc['item_index'], 'count': 0, 'existing': True}
+    known_items = len(items)
+
+    last_user = recsys_db.users.find_one({}, {'_id': 0, 'user_index': 1}, sort=[('user_index', pymongo.DESCENDING)])
+    next_user_index = 0 if last_user is None else last_user['user_index'] + 1
+
+    partition_dir = tempfile.mkdtemp(prefix='apmall_cart_')
+    try:
+        try:
+            total_rows = partition_events(csv_path, partition_dir, num_partitions, chunk_size, items)
+        except Exception as e:
+            print(f'Exception: {str(e)}')
+            return
+
+        index_to_itemId = [None] * len(items)
+        for item in items.values():
+            index_to_itemId[item['item_index']] = item['itemId']
+
+        new_items = [item for item in items.values() if not item.get('existing', False)]
+        print(f'{total_rows} rows, {len(new_items)} new items (indices {known_items} to {len(items) - 1})')
+
+        # new items first so that users never reference an unknown item_index
+        operations = []
+        for item in items.values():
+            if item.get('existing', False):
+                if item['count'] > 0:
+                    operations.append(pymongo.UpdateOne({'itemId': item['itemId']}, {'$inc': {'count': item['count']}}))
+            else:
+                operations.append(pymongo.InsertOne(item))
+
+        for start in range(0, len(operations), write_batch_size):
+            recsys_db.items.bulk_write(operations[start:start + write_batch_size], ordered=False)
+
+        updated_users = 0
+        new_users = 0
+        start = time.time()
+        for ind in range(num_partitions):
+            users = list(iter_user_docs(os.path.join(partition_dir, f'part_{ind}.bin'), index_to_itemId, min_items=1))
+
+            for batch_start in range(0, len(users), write_batch_size):
+                batch = users[batch_start:batch_start + write_batch_size]
+
+                existing = set(doc['userId'] for doc in recsys_db.users.find(
+                    {'userId': {'$in': [user['userId'] for user in batch]}}, {'_id': 0, 'userId': 1}))
+
+                operations = []
+                for user in batch:
+                    update = {
+                        '$push': {
+                            'itemIds': {'$each': user['itemIds']},
+                            'sorted_items': {'$each': user['sorted_items']}
+                        }
+                    }
+
+                    if user['userId'] not in existing:
+                        update['$setOnInsert'] = {'user_index': next_user_index}
+                        next_user_index += 1
+                        new_users += 1
+                    else:
+                        updated_users += 1
+
+                    operations.append(pymongo.UpdateOne({'userId': user['userId']}, update, upsert=True))
+
+                recsys_db.users.bulk_write(operations, ordered=False)
 
-    recsys_db.users.insert_many(list(records))
-    recsys_db.items.insert_many(items)
+            print(f'partition {ind}: {updated_users} users updated, {new_users} users added '
+                  f'({(updated_users + new_users) / (time.time() - start):.0f} users/sec)')
 
-    draw_hist(items)
+        if model_dir is not None:
+            HistoryStore.invalidate(os.path.join(model_dir, 'history_store'))
+            if len(new_items) > 0:
+                ItemIndex.invalidate(os.path.join(model_dir, 'item_index'))
+    finally:
+        shutil.rmtree(partition_dir)
 
 
 def main():
@@ -141,7 +312,6 @@ def main():
                                  authMechanism='SCRAM-SHA-256')
 
     db = client.recsys_apmall
-    # add_cart_data_from_file(db)
     add_cart_data_from_csv(db)
     print("end")
 
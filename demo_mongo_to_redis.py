@@ -1,3 +1,4 @@
+from recsys.ap_recsys import ApRecsys
 from recsys.serve.redis_client import RedisConnectionConfig, RedisClient
 from recsys.train.mongo_client import MongoClient
 
@@ -11,7 +12,8 @@ def main():
                                host='13.209.6.203',
                                db_name='recsys_apmall')
 
-    redis_client = RedisClient(redis_config, expire_time_seconds=None)
+    # trimmed to the history length the model reads
+    redis_client = RedisClient(redis_config, max_seq_len=ApRecsys.default_max_seq_len, expire_time_seconds=None)
     redis_client.flushall()
 
     start = 0
@@ -27,12 +29,15 @@ def main():
     }
 
     while current < end:
+        histories = dict()
         for doc in mongo_client.db.users.find({}, projection).skip(current).limit(batch_size):
 
             if len(doc['sorted_items']) < 2:
                 continue
 
-            redis_client['ap_mall_userId:' + str(doc['user_index'])] = doc['sorted_items']
+            histories['ap_mall_userId:' + str(doc['user_index'])] = doc['sorted_items']
+
+        redis_client.push_many(histories)
 
         current += batch_size
 
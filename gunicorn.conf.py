@@ -0,0 +1,31 @@
+import os
+import multiprocessing
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+
+bind = os.environ.get('RECSYS_BIND', '0.0.0.0:5000')
+
+workers = int(os.environ.get('RECSYS_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+# requests of a worker share its session and micro-batcher
+threads = int(os.environ.get('RECSYS_THREADS', 8))
+
+# import tensorflow and build the app once in the master; the item index and the quantized item embedding store
+# are memory-mapped, so after fork all workers share them in the page cache
+preload_app = True
+
+# one intra-op thread per core and worker unless configured
+os.environ.setdefault('RECSYS_INTRA_OP_THREADS', str(max(1, multiprocessing.cpu_count() // workers)))
+os.environ.setdefault('RECSYS_INTER_OP_THREADS', '1')
+
+timeout = 120
+
+
+def post_fork(server, worker):
+    from wsgi import app
+
+    app.model_holder.load()
+    server.log.info(f'worker {worker.pid} loaded model version {app.model_holder.model.model_version}')
+
+    # /restore reloads only the worker that received it, every worker follows newly published model files itself
+    app.model_holder.watch(interval_seconds=int(os.environ.get('RECSYS_WATCH_SECONDS', 10)))
@@ -1,18 +1,32 @@
 import os
+import copy
+import time
 import shutil
+from contextlib import nullcontext
 
 import numpy as np
 import tensorflow as tf
 from collections import defaultdict
 
+from recsys import versioned_dir
 from recsys.rec_model_impl import RecModel
 from recsys.train.mongo_client import MongoClient
+from recsys.train.history_store import HistoryStore
+from recsys.train.item_index import ItemIndex
 from recsys.train.eval_manager import EvalManager
-from recsys.samplers.sampler import Sampler
+from recsys.samplers.sampler import Sampler, SharedMemorySampler
+from recsys.samplers.batch_generator import TrainBatchGenerator
+from recsys.serve.item_cache import ItemInfoCache
+from recsys.serve.lru_cache import LRUCache
+from recsys.index.quantized import QuantizedIndex
+from recsys.serve.embedding_export import iter_embedding_export, write_embedding_export
 
 
 class ApRecsys(object):
 
+    # histories longer than this are cut, redis keeps the same number of items per user
+    default_max_seq_len = 10
+
     def __init__(self, model_dir, mongoConfig):
 
         self._mongo = MongoClient(host=mongoConfig.host,
@@ -21,10 +35,13 @@ class ApRecsys(object):
                                   db_name=mongoConfig.dbname)
 
         self._dim_item_embed = 50
-        self._max_seq_len = 10
+        self._max_seq_len = self.default_max_seq_len
         self._batch_size = 100
+        self._batches_per_generate = 10
         self._eval_iter = 1000
         self._eval_percentage = 0.1
+        self._num_sampled = None
+        self._candidate_sampler = 'unigram'
 
         self._model = RecModel()
 
@@ -34,14 +51,28 @@ class ApRecsys(object):
         self._serve_session = None
 
         self._train_saver = None
+        self._input_pipeline = False
 
         self._train_writer = None
         self._serve_writer = None
 
+        self._intra_op_threads = None
+        self._inter_op_threads = None
+
         self._eval_manager = EvalManager()
-        self._eval_histories_sample = dict()
+        self._eval_histories_sample = None
         self._min_eval_item_count = 10
+        self._eval_batch_size = 1000
         self._flag_updated = False
+        self._train_sync_variables = None
+
+        self._index = None
+        self._history_store = None
+        self._item_cache = ItemInfoCache(self._mongo)
+        self._recommendation_cache = None
+        self._model_version = None
+        self._serve_total_items = None
+        self._metrics = None
 
         self._save_model_dir = model_dir
         self._save_model_filename = 'model.ckpt'
@@ -49,15 +80,44 @@ class ApRecsys(object):
         self._save_model_path = os.path.join(model_dir, self._save_model_filename)
         self._train_summary_path = os.path.join(model_dir, 'train')
         self._serve_summary_path = os.path.join(model_dir, 'serve')
-
-        if os.path.exists(self._train_summary_path):
-            shutil.rmtree(self._train_summary_path)
-
-        if os.path.exists(self._serve_summary_path):
-            shutil.rmtree(self._serve_summary_path)
+        self._history_store_path = os.path.join(model_dir, 'history_store')
+        self._frozen_serve_model_path = os.path.join(model_dir, 'serve_model.pb')
+        self._loaded_frozen_serve_model = None
+        self._user_tower_filename = 'user_tower.pb'
+        self._frozen_user_tower_path = os.path.join(model_dir, self._user_tower_filename)
+        self._item_embedding_store_path = os.path.join(model_dir, 'item_embedding_store')
+        self._loaded_item_embedding_store = None
+        self._item_index_path = os.path.join(model_dir, 'item_index')
 
         self.load_item_index()
 
+    def new_serve_replica(self):
+        """ an ApRecsys for serving the latest saved model next to this one
+
+        it shares the mongodb connection and the item info cache, and gets its own graph, session, index,
+        recommendation cache and (if items were ingested meanwhile) item index
+        """
+        replica = copy.copy(self)
+        replica._mongo = self._mongo.share()
+        replica._model = RecModel()
+
+        replica._serve_tensors = None
+        replica._serve_session = None
+        replica._serve_writer = None
+        replica._index = None
+        replica._loaded_frozen_serve_model = None
+        replica._loaded_item_embedding_store = None
+        replica._recommendation_cache = None
+        replica._model_version = None
+        replica._serve_total_items = None
+
+        replica.load_item_index()
+        return replica
+
+    def close_serve_session(self):
+        if self._serve_session is not None:
+            self._serve_session.close()
+
     @property
     def batch_size(self):
         return self._batch_size
@@ -98,6 +158,66 @@ class ApRecsys(object):
     def eval_iter(self, value):
         self._eval_iter = value
 
+    @property
+    def num_sampled(self):
+        return self._num_sampled
+
+    @num_sampled.setter
+    def num_sampled(self, value):
+        self._num_sampled = value
+
+    @property
+    def candidate_sampler(self):
+        return self._candidate_sampler
+
+    @candidate_sampler.setter
+    def candidate_sampler(self, value):
+        self._candidate_sampler = value
+
+    @property
+    def eval_batch_size(self):
+        return self._eval_batch_size
+
+    @eval_batch_size.setter
+    def eval_batch_size(self, value):
+        self._eval_batch_size = value
+
+    @property
+    def intra_op_threads(self):
+        return self._intra_op_threads
+
+    @intra_op_threads.setter
+    def intra_op_threads(self, value):
+        self._intra_op_threads = value
+
+    @property
+    def inter_op_threads(self):
+        return self._inter_op_threads
+
+    @inter_op_threads.setter
+    def inter_op_threads(self, value):
+        self._inter_op_threads = value
+
+    def _session_config(self):
+        """ thread pools of new sessions, tensorflow sizes them to all cores by default"""
+        if self._intra_op_threads is None and self._inter_op_threads is None:
+            return None
+
+        return tf.ConfigProto(intra_op_parallelism_threads=self._intra_op_threads or 0,
+                              inter_op_parallelism_threads=self._inter_op_threads or 0)
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, value):
+        """ recsys.serve.metrics.Metrics that times the model call and the top-K search"""
+        self._metrics = value
+
+    def _time_stage(self, stage):
+        return nullcontext() if self._metrics is None else self._metrics.time_stage(stage)
+
     @property
     def train_writer(self):
         if self._train_writer is None:
@@ -106,7 +226,51 @@ class ApRecsys(object):
         return self._train_writer
 
     def load_item_index(self):
-        self._mongo.load_item_index()
+        """ memory-map the persisted item index
+
+        mongodb is only scanned if the index does not exist yet or was invalidated by an ingestion, item infos are
+        not preloaded, the item cache fetches them on the first miss
+        """
+        if self._load_persisted_item_index():
+            return
+
+        with versioned_dir.lock(self._item_index_path):
+            # workers starting together rebuild once, the others load the index the first one saved
+            if not self._load_persisted_item_index():
+                self._refresh_item_index()
+
+    def _load_persisted_item_index(self):
+        if not ItemIndex.exists(self._item_index_path):
+            return False
+
+        try:
+            item_index = ItemIndex.load(self._item_index_path)
+        except ValueError as e:
+            print(f'rebuilding item index: {e}')
+            return False
+
+        self._mongo.item_index = item_index
+        return True
+
+    def refresh_item_index(self):
+        """ rebuild the item index from mongodb (e.g. after ingesting new items) and persist it"""
+        with versioned_dir.lock(self._item_index_path):
+            self._refresh_item_index()
+
+    def _refresh_item_index(self):
+        version = 1
+        if ItemIndex.exists(self._item_index_path):
+            version = ItemIndex.read_meta(self._item_index_path)['version'] + 1
+
+        item_index = self._mongo.load_item_index(item_info_callback=self._item_cache.put, version=version)
+        item_index.save(self._item_index_path)
+
+    @property
+    def total_items(self):
+        return len(self._mongo.item_index)
+
+    def export_item_label_tsv(self, tsv_file_path='item_label.tsv'):
+        self._mongo.export_item_label_tsv(tsv_file_path)
 
     def get_itemId(self, index):
         return self._mongo.get_itemId(index)
@@ -114,12 +278,67 @@ class ApRecsys(object):
     def get_index(self, itemId):
         return self._mongo.get_index(itemId)
 
-    def get_item_info(self, movieId):
-        return self._mongo.get_item_info(movieId)
+    def to_index(self, itemIds, unknown='skip', oov_index=-1):
+        return self._mongo.item_index.to_index(itemIds, unknown=unknown, oov_index=oov_index)
+
+    def to_itemId(self, indices):
+        return self._mongo.item_index.to_itemId(indices)
+
+    def get_item_info(self, itemIds):
+        return self._item_cache.get_item_info(itemIds)
+
+    def get_item_info_by_index(self, indices):
+        return self._item_cache.get_item_info(self.to_itemId(indices))
+
+    def refresh_item_cache(self):
+        self._item_cache.refresh()
+
+    @property
+    def item_cache(self):
+        return self._item_cache
+
+    @property
+    def total_users(self):
+        if self._history_store is not None:
+            return self._history_store.total_users
+
+        return self._mongo.total_users
+
+    def use_history_store(self, rebuild=False):
+        """ read train/eval histories from a local memory-mapped snapshot instead of MongoDB"""
+        if rebuild or not HistoryStore.exists(self._history_store_path):
+            HistoryStore.export(self._mongo, self._history_store_path)
+
+        self._history_store = HistoryStore(self._history_store_path)
+
+    def _get_history(self, user_index):
+        if self._history_store is not None:
+            return self._history_store.get_history(user_index)
+
+        history = self._mongo.get_item_list(user_index)
+        if history is None:
+            return None
+
+        return self.to_index(history, unknown='skip')
+
+    def get_histories(self, start, stop):
+        """ item index histories of users with start <= user_index < stop, keyed by user_index"""
+        if self._history_store is not None:
+            return {ind: self._history_store.get_history(ind) for ind in range(start, min(stop, self.total_users))}
+
+        histories = self._mongo.get_item_lists(start, stop)
+        return {ind: self.to_index(history, unknown='skip') for ind, history in histories.items()}
 
     def _train_batch(self):
 
-        low_pos = int(self._mongo.total_users * self._eval_percentage)
+        low_pos = int(self.total_users * self._eval_percentage)
+
+        if self._history_store is not None:
+            generator = TrainBatchGenerator(self._history_store,
+                                            batch_size=self._batch_size,
+                                            max_seq_len=self.max_seq_len,
+                                            low_user=low_pos)
+            yield from generator(num_batches=self._batches_per_generate)
 
         while True:
             input_npy = np.zeros(self._batch_size,
@@ -129,8 +348,8 @@ class ApRecsys(object):
 
             histories_sample = list()
             while True:
-                index = np.random.randint(low=low_pos, high=self._mongo.total_users - 1)
-                history = self._mongo.get_item_list(index)
+                index = np.random.randint(low=low_pos, high=self.total_users - 1)
+                history = self._get_history(index)
 
                 if history is None:
                     continue
@@ -144,58 +363,97 @@ class ApRecsys(object):
             for ind, history in enumerate(histories_sample):
                 predict_pos = np.random.randint(low=1, high=len(history))
                 train_items = history[max(0, predict_pos - self._max_seq_len): predict_pos]
-                train_items = [self._mongo.get_index(itemId) for itemId in train_items]
 
                 pad_train_items = np.zeros(self.max_seq_len, np.int32)
                 pad_train_items[:len(train_items)] = train_items
-                predict_index = self._mongo.get_index(history[predict_pos])
+                predict_index = history[predict_pos]
                 input_npy[ind] = (pad_train_items, len(train_items), predict_index)
 
             yield input_npy
 
-    def _eval_batch(self):
+    def _load_eval_histories(self):
+        low_pos = max(self._min_eval_item_count, int(self.total_users * self._eval_percentage))
 
-        if len(self._eval_histories_sample) == 0:
-            # low_pos = max(self._min_eval_item_count, int(self._mongo.total_users * self._eval_percentage))
-            low_pos =self._min_eval_item_count
+        pos_items = []
+        seq_item_ids = []
+        seq_lens = []
+        for history in self.get_histories(0, low_pos).values():
+            if len(history) < 2:
+                continue
 
-            index_list = np.arange(start=0, stop=low_pos, step=1)
-            for ind in index_list:
-                history = self._mongo.get_item_list(ind)
-                if len(history) > 1:
-                    history = [self._mongo.get_index(itemId) for itemId in history]
-                    self._eval_histories_sample[ind] = history
+            history = history[-self.max_seq_len - 1:]
+            input_items = history[:-1]
+
+            pad_input_items = np.zeros(self.max_seq_len, np.int32)
+            pad_input_items[:len(input_items)] = input_items
+            seq_item_ids.append(pad_input_items)
+            seq_lens.append(len(input_items))
+            pos_items.append(history[-1])
 
-        predict_pos = -1  # last position
+        input_npy = np.zeros(len(pos_items), dtype=[('seq_item_id', (np.int32, self.max_seq_len)),
+                                                    ('seq_len', np.int32)])
+        if len(pos_items) > 0:
+            input_npy['seq_item_id'] = np.stack(seq_item_ids)
+            input_npy['seq_len'] = seq_lens
+
+        self._eval_histories_sample = (np.array(pos_items, dtype=np.int64), input_npy)
+
+    def _eval_batch(self):
+
+        if self._eval_histories_sample is None:
+            self._load_eval_histories()
+
+        pos_items, input_npy = self._eval_histories_sample
 
         while True:
-            for history in self._eval_histories_sample.values():
-                input_npy = np.zeros(1, dtype=[('seq_item_id', (np.int32, self.max_seq_len)),
-                                               ('seq_len', np.int32)])
-
-                input_items = history[-self.max_seq_len - 1:predict_pos]
-                pad_input_items = np.zeros(self.max_seq_len, np.int32)
-                pad_input_items[:len(input_items)] = input_items
-                input_npy[0] = (pad_input_items, len(input_items))
-                yield history[predict_pos], input_npy
+            for start in range(0, len(pos_items), self._eval_batch_size):
+                stop = start + self._eval_batch_size
+                yield pos_items[start:stop], input_npy[start:stop]
             yield None, None
 
-    def get_train_sampler(self):
-        return Sampler(generate_batch=self._train_batch, num_process=2)
+    def get_train_sampler(self, shared_memory=False, seed=None):
+        if shared_memory:
+            dtype = [('seq_item_id', (np.int32, self.max_seq_len)), ('seq_len', np.int32), ('label', np.int32)]
+            return SharedMemorySampler(generate_batch=self._train_batch, dtype=dtype,
+                                       batch_size=self._batch_size, num_process=2, seed=seed)
+
+        return Sampler(generate_batch=self._train_batch, num_process=2, seed=seed)
 
-    def get_eval_sampler(self):
-        s = Sampler(generate_batch=self._eval_batch, num_process=1)
+    def get_eval_sampler(self, seed=None):
+        s = Sampler(generate_batch=self._eval_batch, num_process=1, seed=seed)
         return s
 
-    def build_train_model(self):
+    def build_train_model(self, train_sampler=None):
+        """ with train_sampler, batches flow through a prefetching tf.data pipeline instead of feed_dict"""
+
+        # summaries belong to the trainer, serving processes on the same model_dir leave them alone
+        for summary_path in [self._train_summary_path, self._serve_summary_path]:
+            if os.path.exists(summary_path):
+                shutil.rmtree(summary_path, ignore_errors=True)
+
+        input_generator = None
+        if train_sampler is not None:
+            def input_generator():
+                for batch in train_sampler.batches():
+                    yield batch['seq_item_id'], batch['seq_len'], batch['label']
+
+        item_counts = None
+        if self._num_sampled is not None:
+            # unigram samples by them, log_uniform is checked against them
+            item_counts = self._mongo.get_item_counts()
 
         self._train_tensors = self._model.build_train_model(batch_size=self._batch_size,
                                                             dim_item_embed=self.dim_item_embed,
-                                                            total_items=self._mongo.total_items,
-                                                            max_seq_len=self.max_seq_len)
+                                                            total_items=self.total_items,
+                                                            max_seq_len=self.max_seq_len,
+                                                            num_sampled=self._num_sampled,
+                                                            candidate_sampler=self._candidate_sampler,
+                                                            item_counts=item_counts,
+                                                            input_generator=input_generator)
+        self._input_pipeline = input_generator is not None
 
         with self._model.get_train_graph().as_default():
-            self._train_session = tf.Session(graph=self._model.get_train_graph())
+            self._train_session = tf.Session(graph=self._model.get_train_graph(), config=self._session_config())
             self._train_session.run(tf.global_variables_initializer())
             self._train_writer = tf.summary.FileWriter(self._train_summary_path, self._model.get_train_graph())
 
@@ -205,18 +463,120 @@ class ApRecsys(object):
     def build_serve_model(self):
 
         self._serve_tensors = self._model.build_serve_model(dim_item_embed=self.dim_item_embed,
-                                                            total_items=self._mongo.total_items,
+                                                            total_items=self.total_items,
                                                             max_seq_len=self.max_seq_len)
+        self._serve_total_items = self.total_items
 
         with self._model.get_serve_graph().as_default():
-            self._serve_session = tf.Session(graph=self._model.get_serve_graph())
+            self._serve_session = tf.Session(graph=self._model.get_serve_graph(), config=self._session_config())
             self._serve_session.run(tf.global_variables_initializer())
             self._serve_writer = tf.summary.FileWriter(self._serve_summary_path, self._model.get_serve_graph())
 
             self.restore(restore_serve=True)
 
-    def train(self, step, batch_data):
-        """train"""
+    def export_serve_model(self, path=None, user_tower_only=False):
+        """ write a frozen inference graph (seq_item_id, seq_len -> user embedding, logits, top-K)
+
+        with user_tower_only only the user embedding is kept, items are then scored by the item embedding store
+        """
+        if path is None:
+            path = self._frozen_user_tower_path if user_tower_only else self._frozen_serve_model_path
+
+        self._model.export_frozen_serve_model(self._serve_session, path, user_tower_only=user_tower_only)
+
+    def has_checkpoint(self):
+        return os.path.exists(self._save_model_path + '.index')
+
+    @property
+    def serve_total_items(self):
+        """ number of items the serve weights (and the item embedding store, if loaded) know, None if unknown
+
+        items ingested after the model was exported have larger item indices, see serves_all_items
+        """
+        if self._loaded_item_embedding_store is not None:
+            if self._serve_total_items is None:
+                return self._index.size
+            return min(self._serve_total_items, self._index.size)
+
+        return self._serve_total_items
+
+    def serves_all_items(self):
+        return self.serve_total_items == self.total_items
+
+    def has_exported_serve_model(self, path=None, user_tower_only=False):
+        if path is None:
+            path = self._frozen_user_tower_path if user_tower_only else self._frozen_serve_model_path
+
+        return os.path.exists(path)
+
+    def load_serve_model(self, path=None, user_tower_only=False):
+        """ serve from a frozen inference graph instead of building the serve model and restoring a checkpoint"""
+        if path is None:
+            path = self._frozen_user_tower_path if user_tower_only else self._frozen_serve_model_path
+
+        self._serve_tensors = self._model.load_frozen_serve_model(path)
+        self._serve_session = tf.Session(graph=self._model.get_serve_graph(), config=self._session_config())
+        self._loaded_frozen_serve_model = path
+
+        if 'total_items' in self._serve_tensors:
+            self._serve_total_items = int(self._serve_session.run(self._serve_tensors['total_items']))
+        elif 'item_embedding' in self._serve_tensors:
+            self._serve_total_items = self._serve_tensors['item_embedding'].shape.as_list()[0]
+        else:
+            # user towers exported before the item count was part of the graph
+            self._serve_total_items = None
+
+        self._on_serve_weights_updated(model_version=self._file_version(path))
+
+    def export_item_embedding_store(self, path=None, quantizer='int8', num_subspaces=10, num_rerank=200,
+                                    with_user_tower=True):
+        """ write the quantized item embeddings (int8 or product quantization) with the float vectors for re-ranking
+
+        with_user_tower the frozen user tower of the same weights is published in the same store version, so a
+        server never pairs user embeddings of one model with item embeddings of another
+        """
+        if path is None:
+            path = self._item_embedding_store_path
+
+        def write_user_tower(version_dir):
+            self._model.export_frozen_serve_model(self._serve_session,
+                                                  os.path.join(version_dir, self._user_tower_filename),
+                                                  user_tower_only=True)
+
+        index = QuantizedIndex(quantizer=quantizer, num_subspaces=num_subspaces, num_rerank=num_rerank)
+        index.build(self.get_item_embeddings())
+        index.save(path, write_files=write_user_tower if with_user_tower else None)
+
+    def has_item_embedding_store(self, path=None, with_user_tower=False):
+        version_dir = QuantizedIndex.version_dir(self._item_embedding_store_path if path is None else path)
+        if version_dir is None:
+            return False
+
+        return not with_user_tower or os.path.exists(os.path.join(version_dir, self._user_tower_filename))
+
+    def load_item_embedding_store(self, path=None, with_user_tower=False):
+        """ recommend from a quantized item embedding store, only the codes are kept in memory
+
+        with_user_tower the serve model becomes the user tower published with the store, both are read from the
+        same store version
+        """
+        if path is None:
+            path = self._item_embedding_store_path
+
+        version_dir = QuantizedIndex.version_dir(path)
+
+        if with_user_tower:
+            # nothing to re-index while the user tower loads, the store of the same version is loaded below
+            self._index = None
+            self._loaded_item_embedding_store = None
+            self.load_serve_model(os.path.join(version_dir, self._user_tower_filename), user_tower_only=True)
+
+        self._index = QuantizedIndex.load_version(version_dir)
+        self._loaded_item_embedding_store = path
+        self.clear_recommendation_cache()
+
+    def train(self, step, batch_data=None):
+        """train, batch_data is ignored when the train model reads from its input pipeline"""
         with self._model.get_train_graph().as_default():
             loss = self._train_tensors['loss']
             backprop = self._train_tensors['backprop']
@@ -224,11 +584,13 @@ class ApRecsys(object):
 
             tf.summary.scalar('loss', loss)
 
-            feed_dict = {
-                self._train_tensors['seq_item_id']: batch_data['seq_item_id'],
-                self._train_tensors['seq_len']: batch_data['seq_len'],
-                self._train_tensors['label']: batch_data['label']
-            }
+            feed_dict = None
+            if not self._input_pipeline:
+                feed_dict = {
+                    self._train_tensors['seq_item_id']: batch_data['seq_item_id'],
+                    self._train_tensors['seq_len']: batch_data['seq_len'],
+                    self._train_tensors['label']: batch_data['label']
+                }
 
             backprop, loss_, summary_ = self._train_session.run([backprop, loss, summary], feed_dict=feed_dict)
 
@@ -239,10 +601,6 @@ class ApRecsys(object):
 
     def serve(self, input):
 
-        if self._flag_updated:
-            self._save_and_load_for_serve()
-            self._flag_updated = False
-
         with self._model.get_serve_graph().as_default():
             logits = self._serve_tensors['logits']
             user_embedding = self._serve_tensors['user_embedding']
@@ -260,38 +618,188 @@ class ApRecsys(object):
             return user_embedding_, logits_
 
     def evaluate(self, eval_sampler, step):
+        if self._flag_updated:
+            self.sync_serve_model()
+
         metric_results = defaultdict(list)
 
         completed_user_count = 0
-        pos_item, input = eval_sampler.next_batch()
+        pos_items, input = eval_sampler.next_batch()
         while input is not None:
             user_embedding, logits = self.serve(input)
-            # print('user_embedding: ',  user_embedding)
-            scores = np.squeeze(logits)
-            result, rank_above = self._eval_manager.full_eval(pos_sample=pos_item, predictions=scores)
-            completed_user_count += 1
+            result, rank_above = self._eval_manager.full_eval(pos_sample=pos_items, predictions=logits)
+            completed_user_count += len(pos_items)
 
             for key in result:
-                metric_results[key].append(result[key])
+                metric_results[key].extend(result[key])
 
-            metric_results['rank_above'].append(rank_above)
+            metric_results['rank_above'].extend(rank_above)
 
-            pos_item, input = eval_sampler.next_batch()
+            pos_items, input = eval_sampler.next_batch()
 
         return metric_results
 
-    def get_item_embeddings(self):
+    def get_user_embeddings(self, input):
+        with self._model.get_serve_graph().as_default():
+            user_embedding = self._serve_tensors['user_embedding']
+
+            feed_dict = {
+                self._serve_tensors['seq_item_id']: input['seq_item_id'],
+                self._serve_tensors['seq_len']: input['seq_len']
+            }
+
+            user_embedding_ = self._serve_session.run(user_embedding, feed_dict=feed_dict)
+            return np.transpose(user_embedding_)
+
+    def get_serve_input(self, index_seqs):
+        """ pack item index sequences (oldest first) into the serve input, keeping the last max_seq_len items
+
+        items the serve weights do not know yet (ingested after the model was exported) are dropped
+        """
+        serve_total_items = self.serve_total_items
+
+        input = np.zeros(len(index_seqs), dtype=[('seq_item_id', (np.int32, self.max_seq_len)), ('seq_len', np.int32)])
+        for row, index_seq in enumerate(index_seqs):
+            if serve_total_items is not None:
+                index_seq = [item_index for item_index in index_seq if item_index < serve_total_items]
+            index_seq = index_seq[-self.max_seq_len:]
+            input['seq_item_id'][row, :len(index_seq)] = index_seq
+            input['seq_len'][row] = len(index_seq)
+
+        return input
+
+    def build_index(self, index):
+        index.build(self.get_item_embeddings())
+        self._index = index
+        self._loaded_item_embedding_store = None
+        self.clear_recommendation_cache()
+
+    def enable_recommendation_cache(self, max_size=100000):
+        """ cache top-K results keyed by the padded input sequence, cleared whenever the serve weights change"""
+        self._recommendation_cache = LRUCache(max_size=max_size)
+
+    def clear_recommendation_cache(self):
+        if self._recommendation_cache is not None:
+            self._recommendation_cache.clear()
+
+    def recommendation_cache_stats(self):
+        if self._recommendation_cache is None:
+            return None
+
+        return self._recommendation_cache.stats()
+
+    @property
+    def model_version(self):
+        """ modification time of the checkpoint or frozen model the serve weights came from"""
+        return self._model_version
+
+    def serve_files_version(self):
+        """ modification times of everything a serving process loads, changes when a new model is published"""
+        paths = [self._save_model_path + '.index',
+                 self._frozen_serve_model_path,
+                 self._frozen_user_tower_path,
+                 os.path.join(self._item_embedding_store_path, versioned_dir.CURRENT_FILENAME),
+                 os.path.join(self._item_index_path, versioned_dir.CURRENT_FILENAME)]
+
+        return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+    @staticmethod
+    def _file_version(path):
+        return str(int(os.path.getmtime(path)))
+
+    def _on_serve_weights_updated(self, model_version=None):
+        if model_version is not None:
+            self._model_version = model_version
+
+        if self._loaded_item_embedding_store is not None:
+            self.load_item_embedding_store(self._loaded_item_embedding_store)
+        elif self._index is not None:
+            self.build_index(self._index)
+
+        self.clear_recommendation_cache()
+
+    def recommend(self, input, top_k):
+        """ returns (item indices, scores) of the top_k items for every row of input"""
+        if self._recommendation_cache is None or len(input) == 0:
+            return self._recommend(input, top_k)
+
+        keys = [(row['seq_item_id'].tobytes(), int(row['seq_len']), top_k) for row in input]
+        cached = [self._recommendation_cache.get(key) for key in keys]
+        missing = [row for row, result in enumerate(cached) if result is None]
+
+        if len(missing) > 0:
+            item_index, scores = self._recommend(input[missing], top_k)
+            for row, row_item_index, row_scores in zip(missing, item_index, scores):
+                cached[row] = (row_item_index, row_scores)
+                self._recommendation_cache.put(keys[row], cached[row])
+
+        return np.stack([result[0] for result in cached]), np.stack([result[1] for result in cached])
+
+    def _recommend(self, input, top_k):
+        if self._index is not None:
+            with self._time_stage('model_call'):
+                user_embeddings = self.get_user_embeddings(input)
+            with self._time_stage('top_k'):
+                return self._index.search(user_embeddings, top_k)
+
         with self._model.get_serve_graph().as_default():
-            item_embedding = self._serve_tensors['item_embedding']
-            item_embedding = self._serve_session.run([item_embedding])
-            return np.squeeze(item_embedding)
+            feed_dict = {
+                self._serve_tensors['seq_item_id']: input['seq_item_id'],
+                self._serve_tensors['seq_len']: input['seq_len'],
+                self._serve_tensors['top_k']: min(top_k, self.serve_total_items)
+            }
+
+            # top-K is part of the graph here
+            fetches = [self._serve_tensors['top_k_indices'], self._serve_tensors['top_k_values']]
+            with self._time_stage('model_call'):
+                return tuple(self._serve_session.run(fetches, feed_dict=feed_dict))
+
+    def get_item_embeddings(self, start=None, stop=None):
+        """ item embedding rows start <= item_index < stop, all items by default"""
+        start = 0 if start is None else start
+        stop = self.total_items if stop is None else stop
+
+        if 'item_embedding' not in self._serve_tensors and self._loaded_item_embedding_store is not None:
+            # a user tower only serve model, the float vectors are read from the store
+            return np.asarray(self._index.embeddings[start:stop])
+
+        with self._model.get_serve_graph().as_default():
+            start_placeholder, stop_placeholder, item_embedding = self._model.get_item_embedding_slice()
+            return self._serve_session.run(item_embedding, feed_dict={start_placeholder: start,
+                                                                       stop_placeholder: stop})
+
+    def _item_range(self, start, stop):
+        start = 0 if start is None else max(0, start)
+        stop = self.total_items if stop is None else min(stop, self.total_items)
+        return start, max(start, stop)
+
+    def iter_item_embeddings(self, start=None, stop=None, with_itemIds=False, chunk_size=65536):
+        """ the binary embedding export of items start <= item_index < stop, in chunks (see embedding_export)"""
+        start, stop = self._item_range(start, stop)
+        return iter_embedding_export(self.get_item_embeddings, start, stop, self.dim_item_embed, self.model_version,
+                                     get_itemIds=self._get_itemId_range if with_itemIds else None,
+                                     chunk_size=chunk_size)
+
+    def export_item_embeddings(self, path, start=None, stop=None, with_itemIds=True, chunk_size=65536):
+        start, stop = self._item_range(start, stop)
+        write_embedding_export(path, self.get_item_embeddings, start, stop, self.dim_item_embed, self.model_version,
+                               get_itemIds=self._get_itemId_range if with_itemIds else None,
+                               chunk_size=chunk_size)
+
+    def _get_itemId_range(self, start, stop):
+        return self.to_itemId(np.arange(start, stop))
 
     def save(self):
         with self._model.get_train_graph().as_default():
             self._train_saver.save(self._train_session, self._save_model_path)
 
     def restore(self, restore_train=False, restore_serve=False):
-        if not os.path.exists(self._save_model_path + '.index'):
+        if restore_serve and self._loaded_frozen_serve_model is not None:
+            # a frozen serve model is reloaded from its own file, not from the checkpoint
+            self.load_serve_model(self._loaded_frozen_serve_model)
+            restore_serve = False
+
+        if not self.has_checkpoint():
             return
 
         if restore_train:
@@ -301,24 +809,55 @@ class ApRecsys(object):
             with self._model.get_serve_graph().as_default():
                 self._restore_only_variable(self._serve_session, self._save_model_path)
 
+            self._on_serve_weights_updated(model_version=self._file_version(self._save_model_path + '.index'))
+
     def _restore_only_variable(self, session, save_model_path):
 
         reader = tf.train.NewCheckpointReader(save_model_path)
         saved_shapes = reader.get_variable_to_shape_map()
 
         restore_vars = []
+        grown_vars = []
         for var in tf.global_variables():
             var_name = var.name.split(':')[0]
             if var_name in saved_shapes and len(var.shape) > 0:
-                if var.get_shape().as_list() == saved_shapes[var_name]:
+                shape = var.get_shape().as_list()
+                saved_shape = saved_shapes[var_name]
+                if shape == saved_shape:
                     restore_vars.append(var)
+                elif shape[1:] == saved_shape[1:] and shape[0] > saved_shape[0]:
+                    # item tables grown by incremental ingestion: keep the trained rows, new items keep their init
+                    grown_vars.append(var)
 
-        saver = tf.train.Saver(restore_vars)
-        saver.restore(session, save_model_path)
+        if len(restore_vars) > 0:
+            saver = tf.train.Saver(restore_vars)
+            saver.restore(session, save_model_path)
+
+        for var in grown_vars:
+            value = session.run(var)
+            saved_value = reader.get_tensor(var.name.split(':')[0])
+            value[:len(saved_value)] = saved_value
+            var.load(value, session)
+
+    def sync_serve_model(self):
+        """ copy the current train weights into the serve graph in memory"""
+        if self._loaded_frozen_serve_model is not None:
+            raise ValueError('a frozen serve model has no variables to sync')
+
+        placeholders = self._serve_tensors['assign_placeholders']
+
+        if self._train_sync_variables is None:
+            train_variables = self._model.get_train_graph().get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+            self._train_sync_variables = {var.name.split(':')[0]: var for var in train_variables
+                                          if var.name.split(':')[0] in placeholders}
+
+        values = self._train_session.run(self._train_sync_variables)
+        feed_dict = {placeholders[var_name]: value for var_name, value in values.items()}
+        self._serve_session.run(self._serve_tensors['assign_op'], feed_dict=feed_dict)
+
+        self._flag_updated = False
 
-    def _save_and_load_for_serve(self):
-        self.save()
-        self.restore(restore_train=True, restore_serve=True)
+        self._on_serve_weights_updated(model_version=str(int(time.time())))
 
     def add_evaluator(self, evaluator):
         self._eval_manager.add_evaluator(evaluator=evaluator)
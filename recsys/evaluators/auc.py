@@ -9,4 +9,4 @@ class AUC(Evaluator):
         super(AUC, self).__init__(name=name)
 
     def compute(self, rank_above, negative_num):
-        return np.mean((negative_num - rank_above) / negative_num)
\ No newline at end of file
+        return (negative_num - np.asarray(rank_above)) / negative_num
\ No newline at end of file
@@ -11,7 +11,7 @@ class Precision(Evaluator):
 
     def compute(self, rank_above, negative_num):
         del negative_num
-        results = np.zeros(len(self._precision_at))
-        results += (rank_above <= self._precision_at).astype(np.float32)
+        rank_above = np.asarray(rank_above)[..., np.newaxis]
+        results = (rank_above <= self._precision_at).astype(np.float32)
 
         return results / self._precision_at
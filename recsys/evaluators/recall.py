@@ -12,7 +12,7 @@ class Recall(Evaluator):
 
     def compute(self, rank_above, negative_num):
         del negative_num
-        results = np.zeros(len(self._recall_at))
-        results += (rank_above <= self._recall_at).astype(np.float32)
+        rank_above = np.asarray(rank_above)[..., np.newaxis]
+        results = (rank_above <= self._recall_at).astype(np.float32)
 
         return results
\ No newline at end of file
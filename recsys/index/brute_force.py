@@ -0,0 +1,19 @@
+from recsys.index.index import Index
+from recsys.ranking import top_k as select_top_k
+
+
+class BruteForceIndex(Index):
+
+    def __init__(self, name='BruteForce'):
+        super(BruteForceIndex, self).__init__(name=name)
+
+    def search(self, queries, top_k):
+        self._check_built()
+        queries = self._as_queries(queries)
+
+        scores = queries @ self._embeddings.T
+        indices, scores = select_top_k(scores, top_k)
+
+        if indices.shape[1] < top_k:
+            return self._pad_results(list(zip(indices, scores)), top_k)
+        return indices, scores
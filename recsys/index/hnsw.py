@@ -0,0 +1,138 @@
+import heapq
+
+import numpy as np
+
+from recsys.index.index import Index
+
+
+class HNSWIndex(Index):
+    """ hierarchical navigable small world graph over inner product similarity
+
+    build inserts one item at a time in pure python, which is slow for large catalogs. meant for small ones and for
+    comparing recall; use IVFIndex or QuantizedIndex for large ones
+    """
+
+    def __init__(self, M=16, ef_construction=100, ef_search=64, seed=0, name='HNSW'):
+        self._M = M
+        self._M0 = 2 * M
+        self._ef_construction = ef_construction
+        self._ef_search = ef_search
+        self._level_mult = 1 / np.log(M)
+        self._seed = seed
+
+        self._layers = []
+        self._entry_point = None
+        self._max_level = -1
+
+        super(HNSWIndex, self).__init__(name=name)
+
+    @property
+    def ef_search(self):
+        return self._ef_search
+
+    @ef_search.setter
+    def ef_search(self, value):
+        self._ef_search = value
+
+    def build(self, embeddings):
+        super(HNSWIndex, self).build(embeddings)
+
+        rng = np.random.RandomState(self._seed)
+        levels = np.floor(-np.log(rng.uniform(size=self.size) + 1e-12) * self._level_mult).astype(np.int64)
+
+        self._layers = []
+        self._entry_point = None
+        self._max_level = -1
+        for node, level in enumerate(levels):
+            self._insert(node, level)
+
+    def _insert(self, node, level):
+        while len(self._layers) <= level:
+            self._layers.append(dict())
+
+        for layer in range(level + 1):
+            self._layers[layer][node] = []
+
+        if self._entry_point is None:
+            self._entry_point = node
+            self._max_level = level
+            return
+
+        query = self._embeddings[node]
+        entry_points = [self._entry_point]
+        top_level = self._max_level
+
+        for layer in range(top_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+
+        for layer in range(min(level, top_level), -1, -1):
+            nearest = self._search_layer(query, entry_points, self._ef_construction, layer)
+            max_neighbors = self._M0 if layer == 0 else self._M
+            neighbors = [n for _, n in nearest[:self._M]]
+
+            self._layers[layer][node] = neighbors
+            for neighbor in neighbors:
+                links = self._layers[layer][neighbor]
+                links.append(node)
+                if len(links) > max_neighbors:
+                    self._layers[layer][neighbor] = self._shrink(neighbor, links, max_neighbors)
+
+            entry_points = [n for _, n in nearest]
+
+        if level > top_level:
+            self._entry_point = node
+            self._max_level = level
+
+    def _shrink(self, node, links, max_neighbors):
+        links = np.array(links)
+        scores = self._embeddings[links] @ self._embeddings[node]
+        return list(links[np.argsort(-scores)[:max_neighbors]])
+
+    def _search_layer(self, query, entry_points, ef, layer):
+        """ returns [(score, node)] sorted by descending score"""
+        graph = self._layers[layer]
+        visited = set(entry_points)
+
+        entry_scores = self._embeddings[entry_points] @ query
+        candidates = [(-score, node) for score, node in zip(entry_scores, entry_points)]
+        heapq.heapify(candidates)
+        results = [(score, node) for score, node in zip(entry_scores, entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_score, node = heapq.heappop(candidates)
+            if len(results) >= ef and -neg_score < results[0][0]:
+                break
+
+            neighbors = [n for n in graph[node] if n not in visited]
+            if len(neighbors) == 0:
+                continue
+            visited.update(neighbors)
+
+            scores = self._embeddings[neighbors] @ query
+            for score, neighbor in zip(scores, neighbors):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbor))
+                    heapq.heappush(results, (score, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted(results, reverse=True)
+
+    def search(self, queries, top_k):
+        self._check_built()
+        queries = self._as_queries(queries)
+
+        ef = max(self._ef_search, top_k)
+        results = []
+        for query in queries:
+            entry_points = [self._entry_point]
+            for layer in range(self._max_level, 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+
+            nearest = self._search_layer(query, entry_points, ef, 0)[:top_k]
+            results.append(([n for _, n in nearest], [s for s, _ in nearest]))
+
+        return self._pad_results(results, top_k)
@@ -0,0 +1,48 @@
+import numpy as np
+
+from recsys.ranking import top_k as select_top_k
+
+
+class Index(object):
+
+    def __init__(self, name):
+        self.name = name
+        self._embeddings = None
+
+    @property
+    def size(self):
+        if self._embeddings is None:
+            return 0
+
+        return len(self._embeddings)
+
+    def build(self, embeddings):
+        self._embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def search(self, queries, top_k):
+        """ returns (indices, scores) of shape (num_queries, top_k) ordered by descending inner product"""
+        raise NotImplementedError
+
+    def _check_built(self):
+        if self._embeddings is None:
+            raise ValueError(f'{self.name} index is not built')
+
+    @staticmethod
+    def _as_queries(queries):
+        queries = np.asarray(queries, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[np.newaxis, :]
+        return queries
+
+    @staticmethod
+    def _select_top_k(candidates, scores, top_k):
+        order, scores = select_top_k(scores, top_k)
+        return candidates[order], scores
+
+    def _pad_results(self, results, top_k):
+        indices = np.full((len(results), top_k), -1, dtype=np.int64)
+        scores = np.full((len(results), top_k), -np.inf, dtype=np.float32)
+        for row, (row_indices, row_scores) in enumerate(results):
+            indices[row, :len(row_indices)] = row_indices
+            scores[row, :len(row_scores)] = row_scores
+        return indices, scores
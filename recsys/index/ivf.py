@@ -0,0 +1,97 @@
+import numpy as np
+
+from recsys.index.index import Index
+
+
+class IVFIndex(Index):
+    """ inverted file index: items are clustered with k-means and only the closest clusters are scanned
+
+    the centroids are trained on at most train_points_per_cluster sampled items per cluster, all items are then
+    assigned chunk_size at a time, so building never holds an items x clusters distance matrix
+    """
+
+    def __init__(self, num_clusters=None, num_probe=8, num_iter=10, seed=0, train_points_per_cluster=256,
+                 chunk_size=65536, name='IVF'):
+        self._num_clusters = num_clusters
+        self._num_probe = num_probe
+        self._num_iter = num_iter
+        self._seed = seed
+        self._train_points_per_cluster = train_points_per_cluster
+        self._chunk_size = chunk_size
+
+        self._centroids = None
+        self._list_offsets = None
+        self._list_items = None
+
+        super(IVFIndex, self).__init__(name=name)
+
+    @property
+    def num_probe(self):
+        return self._num_probe
+
+    @num_probe.setter
+    def num_probe(self, value):
+        self._num_probe = value
+
+    def build(self, embeddings):
+        super(IVFIndex, self).build(embeddings)
+
+        num_clusters = self._num_clusters
+        if num_clusters is None:
+            num_clusters = int(np.sqrt(self.size))
+        num_clusters = max(1, min(num_clusters, self.size))
+
+        rng = np.random.RandomState(self._seed)
+        num_train = min(self.size, num_clusters * self._train_points_per_cluster)
+        train_vectors = self._embeddings[np.sort(rng.choice(self.size, num_train, replace=False))]
+
+        self._centroids = self._kmeans(train_vectors, num_clusters, rng)
+        assignment = self._assign(self._embeddings, self._centroids)
+
+        # CSR layout of the inverted lists
+        self._list_items = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=num_clusters)
+        self._list_offsets = np.zeros(num_clusters + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._list_offsets[1:])
+
+    def _assign(self, vectors, centroids):
+        # the squared norm of the vector does not change the closest centroid
+        centroid_norms = np.sum(centroids ** 2, axis=1)
+        return np.concatenate([np.argmin(centroid_norms - 2 * vectors[start:start + self._chunk_size] @ centroids.T,
+                                         axis=1)
+                               for start in range(0, len(vectors), self._chunk_size)])
+
+    def _kmeans(self, vectors, num_clusters, rng):
+        centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].astype(np.float32)
+
+        assignment = None
+        for _ in range(self._num_iter):
+            new_assignment = self._assign(vectors, centroids)
+            if assignment is not None and np.array_equal(assignment, new_assignment):
+                break
+            assignment = new_assignment
+
+            counts = np.bincount(assignment, minlength=num_clusters)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+
+        return centroids
+
+    def search(self, queries, top_k):
+        self._check_built()
+        queries = self._as_queries(queries)
+
+        num_probe = min(self._num_probe, len(self._centroids))
+        centroid_scores = queries @ self._centroids.T
+        probes = np.argpartition(-centroid_scores, num_probe - 1, axis=1)[:, :num_probe]
+
+        results = []
+        for query, probe in zip(queries, probes):
+            candidates = np.concatenate([self._list_items[self._list_offsets[c]:self._list_offsets[c + 1]]
+                                         for c in probe])
+            scores = self._embeddings[candidates] @ query
+            results.append(self._select_top_k(candidates, scores, top_k))
+
+        return self._pad_results(results, top_k)
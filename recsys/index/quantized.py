@@ -0,0 +1,213 @@
+import os
+import json
+
+import numpy as np
+
+from recsys import versioned_dir
+from recsys.index.index import Index
+from recsys.ranking import top_k as select_top_k
+
+
+class ScalarQuantizer(object):
+    """ per dimension uint8 codes, x ~= offset + scale * code"""
+
+    name = 'int8'
+
+    def __init__(self):
+        self.offset = None
+        self.scale = None
+
+    def train(self, vectors):
+        self.offset = vectors.min(axis=0)
+        self.scale = np.maximum(vectors.max(axis=0) - self.offset, 1e-12) / 255.0
+
+    def encode(self, vectors):
+        return np.clip(np.rint((vectors - self.offset) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        return self.offset + codes.astype(np.float32) * self.scale
+
+    def scores(self, queries, codes):
+        # q . (offset + scale * c) = q . offset + (q * scale) . c
+        return queries @ self.offset[:, np.newaxis] + (queries * self.scale) @ codes.T.astype(np.float32)
+
+    def state(self):
+        return {'offset': self.offset, 'scale': self.scale}
+
+    def load_state(self, state):
+        self.offset = state['offset']
+        self.scale = state['scale']
+
+
+class ProductQuantizer(object):
+    """ splits vectors into num_subspaces parts, each encoded by the nearest of 256 k-means centroids"""
+
+    name = 'pq'
+
+    def __init__(self, num_subspaces=10, num_iter=10, seed=0):
+        self._num_subspaces = num_subspaces
+        self._num_iter = num_iter
+        self._seed = seed
+        self.centroids = None
+
+    def _split(self, vectors):
+        return np.array_split(vectors, self._num_subspaces, axis=1)
+
+    def train(self, vectors):
+        rng = np.random.RandomState(self._seed)
+        num_centroids = min(256, len(vectors))
+
+        self.centroids = []
+        for sub_vectors in self._split(vectors):
+            centroids = sub_vectors[rng.choice(len(sub_vectors), num_centroids, replace=False)].copy()
+            for _ in range(self._num_iter):
+                assignment = self._assign(sub_vectors, centroids)
+                counts = np.bincount(assignment, minlength=num_centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sub_vectors)
+                non_empty = counts > 0
+                centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+            self.centroids.append(centroids)
+
+    @staticmethod
+    def _assign(vectors, centroids):
+        distances = -2 * vectors @ centroids.T + np.sum(centroids ** 2, axis=1)
+        return np.argmin(distances, axis=1)
+
+    def encode(self, vectors):
+        return np.stack([self._assign(sub_vectors, centroids)
+                         for sub_vectors, centroids in zip(self._split(vectors), self.centroids)], axis=1).astype(np.uint8)
+
+    def decode(self, codes):
+        return np.concatenate([centroids[codes[:, m]] for m, centroids in enumerate(self.centroids)], axis=1)
+
+    def scores(self, queries, codes):
+        # asymmetric distance: one lookup table per subspace, scores are sums of table entries
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for m, (sub_queries, centroids) in enumerate(zip(self._split(queries), self.centroids)):
+            table = sub_queries @ centroids.T
+            scores += table[:, codes[:, m]]
+        return scores
+
+    def state(self):
+        return {f'centroids_{m}': centroids for m, centroids in enumerate(self.centroids)}
+
+    def load_state(self, state):
+        self._num_subspaces = len(state)
+        self.centroids = [state[f'centroids_{m}'] for m in range(self._num_subspaces)]
+
+
+class QuantizedIndex(Index):
+    """ scores every item on compressed codes, then re-ranks a shortlist of num_rerank items with float vectors
+
+    after save/load the float vectors are memory-mapped, only the codes have to stay resident.
+    every save writes a new version directory and then switches the CURRENT pointer, so files that serving
+    processes have memory-mapped are never rewritten in place (see versioned_dir). files that belong to the same
+    version, e.g. the user tower that produced the embeddings, can be written next to them before publishing.
+    """
+
+    _meta_filename = 'meta.json'
+
+    def __init__(self, quantizer='int8', num_subspaces=10, num_rerank=200, chunk_size=65536, name='Quantized'):
+        if quantizer == 'int8':
+            self._quantizer = ScalarQuantizer()
+        elif quantizer == 'pq':
+            self._quantizer = ProductQuantizer(num_subspaces=num_subspaces)
+        else:
+            raise ValueError(f'Invalid quantizer: {quantizer}')
+
+        self._num_rerank = num_rerank
+        self._chunk_size = chunk_size
+        self._codes = None
+
+        super(QuantizedIndex, self).__init__(name=name)
+
+    @property
+    def embeddings(self):
+        return self._embeddings
+
+    def build(self, embeddings):
+        super(QuantizedIndex, self).build(embeddings)
+
+        self._quantizer.train(self._embeddings)
+        self._codes = np.concatenate([self._quantizer.encode(self._embeddings[start:start + self._chunk_size])
+                                      for start in range(0, self.size, self._chunk_size)])
+
+    def search(self, queries, top_k):
+        self._check_built()
+        queries = self._as_queries(queries)
+
+        num_rerank = min(max(self._num_rerank, top_k), self.size)
+
+        # shortlist per chunk so that the approximate score matrix stays bounded
+        shortlist_indices = []
+        shortlist_scores = []
+        for start in range(0, self.size, self._chunk_size):
+            scores = self._quantizer.scores(queries, self._codes[start:start + self._chunk_size])
+            indices, scores = select_top_k(scores, num_rerank)
+            shortlist_indices.append(indices + start)
+            shortlist_scores.append(scores)
+
+        indices, _ = select_top_k(np.concatenate(shortlist_scores, axis=1), num_rerank)
+        shortlist = np.take_along_axis(np.concatenate(shortlist_indices, axis=1), indices, axis=1)
+
+        results = []
+        for query, candidates in zip(queries, shortlist):
+            order = np.argsort(candidates)
+            candidates = candidates[order]
+            scores = self._embeddings[candidates] @ query
+            results.append(self._select_top_k(candidates, scores, top_k))
+
+        return self._pad_results(results, top_k)
+
+    @classmethod
+    def exists(cls, store_dir):
+        return versioned_dir.current_dir(store_dir) is not None
+
+    @classmethod
+    def version_dir(cls, store_dir):
+        """ directory of the published version"""
+        return versioned_dir.current_dir(store_dir)
+
+    def save(self, store_dir, write_files=None):
+        """ publish a new version, write_files(version dir) adds files to it before it becomes visible"""
+        self._check_built()
+        os.makedirs(store_dir, exist_ok=True)
+
+        version_dir = versioned_dir.new_version_dir(store_dir)
+
+        np.save(os.path.join(version_dir, 'embeddings.npy'), self._embeddings)
+        np.save(os.path.join(version_dir, 'codes.npy'), self._codes)
+        np.savez(os.path.join(version_dir, 'quantizer.npz'), **self._quantizer.state())
+
+        meta = {
+            'quantizer': self._quantizer.name,
+            'num_rerank': self._num_rerank,
+            'chunk_size': self._chunk_size,
+            'size': self.size
+        }
+        with open(os.path.join(version_dir, self._meta_filename), 'w') as f:
+            json.dump(meta, f)
+
+        if write_files is not None:
+            write_files(version_dir)
+
+        versioned_dir.publish(store_dir, version_dir)
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        """ codes are memory-mapped too unless mmap_mode is None, so serving processes share them in the page cache"""
+        return cls.load_version(cls.version_dir(store_dir), mmap_mode=mmap_mode)
+
+    @classmethod
+    def load_version(cls, version_dir, mmap_mode='r'):
+        with open(os.path.join(version_dir, cls._meta_filename), 'r') as f:
+            meta = json.load(f)
+
+        index = cls(quantizer=meta['quantizer'], num_rerank=meta['num_rerank'], chunk_size=meta['chunk_size'])
+        with np.load(os.path.join(version_dir, 'quantizer.npz')) as state:
+            index._quantizer.load_state(dict(state))
+        index._codes = np.load(os.path.join(version_dir, 'codes.npy'), mmap_mode=mmap_mode)
+        index._embeddings = np.load(os.path.join(version_dir, 'embeddings.npy'), mmap_mode='r')
+
+        return index
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+def top_k(scores, k):
+    """ partial top-k selection along the last axis, returns (indices, values) in descending order"""
+    scores = np.asarray(scores)
+    num_items = scores.shape[-1]
+    k = min(k, num_items)
+
+    if k < num_items:
+        indices = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        indices = np.broadcast_to(np.arange(num_items), scores.shape).copy()
+
+    values = np.take_along_axis(scores, indices, axis=-1)
+    order = np.argsort(-values, axis=-1, kind='stable')
+
+    return np.take_along_axis(indices, order, axis=-1), np.take_along_axis(values, order, axis=-1)
+
+
+def rank_above(scores, pos_items):
+    """ number of items scored strictly higher than the positive item, for one or many users"""
+    scores = np.asarray(scores)
+    pos_items = np.asarray(pos_items)
+
+    if scores.ndim == 1:
+        return int(np.count_nonzero(scores > scores[pos_items]))
+
+    pos_scores = np.take_along_axis(scores, pos_items.reshape(-1, 1), axis=1)
+    return np.count_nonzero(scores > pos_scores, axis=1)
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 import tensorflow as tf
 
 
@@ -13,7 +16,7 @@ def get_latent_factor(name, embedding_size, total_items, tensor_id):
     return embedding, item_vectors
 
 
-def get_MultiLayerFC(name, dim_item_embed, total_items, tensor_in_tensor):
+def get_MultiLayerFC(name, dim_item_embed, total_items, tensor_in_tensor, compute_logits=True):
     tensors = dict()
 
     with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
@@ -61,21 +64,68 @@ def get_MultiLayerFC(name, dim_item_embed, total_items, tensor_in_tensor):
                                    trainable=True,
                                    initializer=tf.contrib.layers.xavier_initializer())
 
-        _user_embedding = tf.transpose(_user_embedding)
-        _logits = tf.matmul(_item_embedding, _user_embedding)
-        _logits = tf.transpose(_logits)
-
-        tensors['logits'] = _logits
         tensors['item_embedding'] = _item_embedding
+        tensors['user_vector'] = _user_embedding
+
+        _user_embedding = tf.transpose(_user_embedding)
         tensors['user_embedding'] = _user_embedding
 
-        tf.summary.histogram('logits', _logits)
+        if compute_logits:
+            _logits = tf.matmul(_item_embedding, _user_embedding)
+            _logits = tf.transpose(_logits)
+            tensors['logits'] = _logits
+
+            tf.summary.histogram('logits', _logits)
 
         return tensors
 
 
+def get_sampled_softmax_loss(tensor_item_embedding, tensor_user_vector, tensor_label, total_items, num_sampled,
+                             candidate_sampler, item_counts):
+    """ sampled softmax over num_sampled negatives, the sampling probability is subtracted from the logits (logQ)
+
+    'unigram' samples proportionally to item_counts^0.75. 'log_uniform' assumes item indices are ordered by
+    decreasing popularity, which the importers do not do (they assign indices in first-seen order), so it is
+    rejected when item_counts show otherwise
+    """
+    labels = tf.cast(tf.expand_dims(tensor_label, axis=1), tf.int64)
+
+    if candidate_sampler == 'unigram':
+        if item_counts is None:
+            raise ValueError('unigram candidate sampler requires item_counts')
+
+        sampled_values = tf.nn.fixed_unigram_candidate_sampler(true_classes=labels,
+                                                               num_true=1,
+                                                               num_sampled=num_sampled,
+                                                               unique=True,
+                                                               range_max=total_items,
+                                                               distortion=0.75,
+                                                               unigrams=[float(count) + 1.0 for count in item_counts])
+    elif candidate_sampler == 'log_uniform':
+        if item_counts is not None and np.any(np.diff(item_counts) > 0):
+            raise ValueError('log_uniform candidate sampler requires item indices sorted by decreasing popularity, '
+                             'use unigram')
+
+        sampled_values = tf.nn.log_uniform_candidate_sampler(true_classes=labels,
+                                                             num_true=1,
+                                                             num_sampled=num_sampled,
+                                                             unique=True,
+                                                             range_max=total_items)
+    else:
+        raise ValueError(f'Invalid candidate sampler: {candidate_sampler}')
+
+    return tf.nn.sampled_softmax_loss(weights=tensor_item_embedding,
+                                      biases=tf.zeros(shape=(total_items,), dtype=tf.float32),
+                                      labels=labels,
+                                      inputs=tensor_user_vector,
+                                      num_sampled=num_sampled,
+                                      num_classes=total_items,
+                                      sampled_values=sampled_values,
+                                      remove_accidental_hits=True)
+
+
 def get_mlp_softmax(name, tensor_item_vectors, tensor_label, tensor_seq_len, max_seq_len, dim_item_embed,
-                    total_items, train):
+                    total_items, train, num_sampled=None, candidate_sampler='unigram', item_counts=None):
     with tf.variable_scope(name_or_scope=name, reuse=tf.AUTO_REUSE):
 
         # average item vectors user interacted with
@@ -84,31 +134,89 @@ def get_mlp_softmax(name, tensor_item_vectors, tensor_label, tensor_seq_len, max
 
         in_tensor = tf.concat(values=[seq_vec], axis=1)
 
+        sampled = train and num_sampled is not None
+
         tensors = get_MultiLayerFC(name='mlp',
                                    dim_item_embed=dim_item_embed,
                                    total_items=total_items,
-                                   tensor_in_tensor=in_tensor)
-
-        if train:
+                                   tensor_in_tensor=in_tensor,
+                                   compute_logits=not sampled)
+
+        if sampled:
+            tensors['losses'] = get_sampled_softmax_loss(tensor_item_embedding=tensors['item_embedding'],
+                                                         tensor_user_vector=tensors['user_vector'],
+                                                         tensor_label=tensor_label,
+                                                         total_items=total_items,
+                                                         num_sampled=num_sampled,
+                                                         candidate_sampler=candidate_sampler,
+                                                         item_counts=item_counts)
+        elif train:
             _losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tensor_label, logits=tensors['logits'])
             tensors['losses'] = _losses
 
         return tensors
 
 
+def get_assign_ops(variables):
+    """ placeholders keyed by variable name and a single op assigning all of them"""
+    placeholders = dict()
+    assign_ops = []
+    for var in variables:
+        var_name = var.name.split(':')[0]
+        placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape(), name=var_name.replace('/', '_') + '_value')
+        placeholders[var_name] = placeholder
+        assign_ops.append(tf.assign(var, placeholder))
+
+    return placeholders, tf.group(*assign_ops)
+
+
+def get_input_tensors(input_generator, max_seq_len, prefetch_size=8):
+    """ tf.data pipeline over a python generator of (seq_item_id, seq_len, label) batches
+
+    batches are built by the sampler workers, the pipeline only prefetches them ahead of the train step
+    """
+    dataset = tf.data.Dataset.from_generator(input_generator,
+                                             output_types=(tf.int32, tf.int32, tf.int32),
+                                             output_shapes=(tf.TensorShape([None, max_seq_len]),
+                                                            tf.TensorShape([None]),
+                                                            tf.TensorShape([None])))
+
+    dataset = dataset.prefetch(prefetch_size)
+
+    return dataset.make_one_shot_iterator().get_next()
+
+
+SERVE_INPUT_NAMES = ['seq_item_id', 'seq_len', 'top_k']
+SERVE_OUTPUT_NAMES = ['user_embedding', 'logits', 'item_embedding', 'top_k_values', 'top_k_indices', 'total_items']
+
+# the user tower alone, item scoring is left to an external item embedding store
+USER_TOWER_INPUT_NAMES = ['seq_item_id', 'seq_len']
+USER_TOWER_OUTPUT_NAMES = ['user_embedding', 'total_items']
+
+
 class RecModel(object):
 
     def __init__(self):
         self._train_graph = tf.Graph()
         self._serv_graph = tf.Graph()
+        self._item_embedding_slice = None
 
-    def build_train_model(self, batch_size, dim_item_embed, total_items, max_seq_len):
-        """ build train model"""
+    def build_train_model(self, batch_size, dim_item_embed, total_items, max_seq_len, num_sampled=None,
+                          candidate_sampler='unigram', item_counts=None, input_generator=None):
+        """ build train model, with full softmax or, if num_sampled is given, sampled softmax
+
+        inputs are fed through placeholders, or read from a tf.data pipeline when input_generator is given.
+        the batch dimension is dynamic, the batch size is whatever the feed or the generator provides.
+        """
 
         with self._train_graph.as_default():
-            seq_item_id = tf.placeholder(tf.int32, shape=(batch_size, max_seq_len), name='seq_item_id')
-            seq_len = tf.placeholder(tf.int32, shape=(batch_size,), name='seq_len')
-            label = tf.placeholder(tf.int32, shape=(batch_size,), name='label')
+            if input_generator is None:
+                seq_item_id = tf.placeholder(tf.int32, shape=(None, max_seq_len), name='seq_item_id')
+                seq_len = tf.placeholder(tf.int32, shape=(None,), name='seq_len')
+                label = tf.placeholder(tf.int32, shape=(None,), name='label')
+            else:
+                seq_item_id, seq_len, label = get_input_tensors(input_generator=input_generator,
+                                                                max_seq_len=max_seq_len)
 
             _, item_vectors = get_latent_factor(name='latent_factor',
                                                 embedding_size=dim_item_embed,
@@ -122,7 +230,10 @@ class RecModel(object):
                                       max_seq_len=max_seq_len,
                                       dim_item_embed=dim_item_embed,
                                       total_items=total_items,
-                                      train=True)
+                                      train=True,
+                                      num_sampled=num_sampled,
+                                      candidate_sampler=candidate_sampler,
+                                      item_counts=item_counts)
 
             tensors['seq_item_id'] = seq_item_id
             tensors['seq_len'] = seq_len
@@ -167,8 +278,86 @@ class RecModel(object):
             tensors['seq_item_id'] = seq_item_id
             tensors['seq_len'] = seq_len
 
+            # named outputs, kept by export_frozen_serve_model
+            tensors['user_embedding'] = tf.identity(tensors['user_embedding'], name='user_embedding')
+            tensors['logits'] = tf.identity(tensors['logits'], name='logits')
+            tensors['item_embedding'] = tf.identity(tensors['item_embedding'], name='item_embedding')
+
+            # a plain int32 placeholder: strip_unused_nodes would turn a placeholder_with_default into a float one
+            top_k = tf.placeholder(tf.int32, shape=(), name='top_k')
+            top_k_values, top_k_indices = tf.nn.top_k(tensors['logits'], k=top_k)
+            tensors['top_k'] = top_k
+            tensors['top_k_values'] = tf.identity(top_k_values, name='top_k_values')
+            tensors['top_k_indices'] = tf.identity(top_k_indices, name='top_k_indices')
+
+            # the number of item rows, exported with the frozen graphs so that servers can detect newer items
+            tensors['total_items'] = tf.constant(total_items, dtype=tf.int32, name='total_items')
+
+            assign_placeholders, assign_op = get_assign_ops(tf.global_variables())
+            tensors['assign_placeholders'] = assign_placeholders
+            tensors['assign_op'] = assign_op
+
             return tensors
 
+    def export_frozen_serve_model(self, session, path, user_tower_only=False):
+        """ write the serve graph with variables folded into constants and everything else stripped
+
+        with user_tower_only the item embedding and everything that scores items is stripped as well
+        """
+        from tensorflow.tools.graph_transforms import TransformGraph
+
+        if user_tower_only:
+            input_names, output_names = USER_TOWER_INPUT_NAMES, USER_TOWER_OUTPUT_NAMES
+        else:
+            input_names, output_names = SERVE_INPUT_NAMES, SERVE_OUTPUT_NAMES
+
+        graph_def = tf.graph_util.convert_variables_to_constants(session,
+                                                                 self._serv_graph.as_graph_def(),
+                                                                 output_names)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+        graph_def = TransformGraph(graph_def, input_names, output_names,
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)',
+                                    'sort_by_execution_order'])
+
+        # a serving process may be (re)loading path, replace it in one step
+        tmp_path = path + '.tmp'
+        with tf.gfile.GFile(tmp_path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        os.replace(tmp_path, path)
+
+    def load_frozen_serve_model(self, path):
+        """ replace the serve graph with a frozen one written by export_frozen_serve_model
+
+        only the tensors present in the frozen graph are returned
+        """
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self._serv_graph = tf.Graph()
+        with self._serv_graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        node_names = {node.name for node in graph_def.node}
+
+        tensors = dict()
+        for name in SERVE_INPUT_NAMES + SERVE_OUTPUT_NAMES:
+            if name in node_names:
+                tensors[name] = self._serv_graph.get_tensor_by_name(name + ':0')
+
+        return tensors
+
+    def get_item_embedding_slice(self):
+        """ (start, stop, item_embedding[start:stop]) on the serve graph, added once per serve graph"""
+        if self._item_embedding_slice is None or self._item_embedding_slice[0].graph is not self._serv_graph:
+            with self._serv_graph.as_default():
+                item_embedding = self._serv_graph.get_tensor_by_name('item_embedding:0')
+                start = tf.placeholder(tf.int32, shape=(), name='item_embedding_start')
+                stop = tf.placeholder(tf.int32, shape=(), name='item_embedding_stop')
+                self._item_embedding_slice = (start, stop, item_embedding[start:stop])
+
+        return self._item_embedding_slice
+
     def get_train_graph(self):
         return self._train_graph
 
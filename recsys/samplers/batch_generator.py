@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class TrainBatchGenerator(object):
+    """ draws (history window, next item) training examples for whole batches at once from a HistoryStore"""
+
+    def __init__(self, history_store, batch_size, max_seq_len, low_user=0, high_user=None):
+        self._offsets = history_store.offsets
+        self._items = history_store.items
+        self._batch_size = batch_size
+        self._max_seq_len = max_seq_len
+
+        if high_user is None:
+            high_user = history_store.total_users
+
+        lengths = np.diff(self._offsets[low_user:high_user + 1])
+        self._users = low_user + np.flatnonzero(lengths > 1)
+
+        if len(self._users) == 0:
+            raise ValueError('no user with at least 2 items to sample from')
+
+        self._dtype = np.dtype([('seq_item_id', (np.int32, max_seq_len)),
+                                ('seq_len', np.int32),
+                                ('label', np.int32)])
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def sample(self, num_batches=1, rng=np.random):
+        """ returns a structured array of shape (num_batches, batch_size)"""
+        num_samples = num_batches * self._batch_size
+
+        users = self._users[rng.randint(len(self._users), size=num_samples)]
+        starts = self._offsets[users]
+        lengths = self._offsets[users + 1] - starts
+
+        predict_pos = rng.randint(1, lengths)
+        window_start = np.maximum(0, predict_pos - self._max_seq_len)
+        seq_len = predict_pos - window_start
+
+        positions = np.arange(self._max_seq_len)
+        mask = positions < seq_len[:, np.newaxis]
+        gather = np.where(mask, (starts + window_start)[:, np.newaxis] + positions, 0)
+
+        batches = np.zeros(num_samples, dtype=self._dtype)
+        batches['seq_item_id'] = np.where(mask, self._items[gather], 0)
+        batches['seq_len'] = seq_len
+        batches['label'] = self._items[starts + predict_pos]
+
+        return batches.reshape(num_batches, self._batch_size)
+
+    def __call__(self, num_batches=1, rng=np.random):
+        while True:
+            for batch in self.sample(num_batches, rng):
+                yield batch
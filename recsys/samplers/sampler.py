@@ -1,22 +1,80 @@
 import os
+import time
+import queue
+import ctypes
+import random
 import multiprocessing
-from multiprocessing import Queue, Process
+from collections import deque
+from multiprocessing import Queue, Process, RawArray
+
+import numpy as np
+
+
+class SamplerTimeoutError(Exception):
+    pass
+
+
+def _worker_seed(seed, worker_index, generation):
+    return (seed + 1000003 * worker_index + 7919 * generation) % (2 ** 32)
 
 
 class _Process(Process):
 
-    def __init__(self, queue, generate_batch):
+    def __init__(self, queue, generate_batch, seed):
         self._queue = queue
         self._generate_batch = generate_batch
+        self._seed = seed
         super(_Process, self).__init__()
+        self.daemon = True
 
     def run(self):
+        # forked workers inherit the parent's RNG state, so reseed before generating
+        random.seed(self._seed)
+        np.random.seed(self._seed)
+
         for input in self._generate_batch():
-            self._queue.put(input, block=True)
+            self._put(input)
+
+    def _put(self, input):
+        self._queue.put(input, block=True)
+
+
+class _SharedMemoryProcess(_Process):
+
+    def __init__(self, free_slots, ready_slots, buffers, dtype, batch_size, generate_batch, seed):
+        self._free_slots = free_slots
+        self._buffers = buffers
+        self._dtype = dtype
+        self._batch_size = batch_size
+        self._slots = None
+        super(_SharedMemoryProcess, self).__init__(ready_slots, generate_batch, seed)
+
+    def run(self):
+        self._slots = [np.frombuffer(buffer, dtype=self._dtype, count=self._batch_size) for buffer in self._buffers]
+        super(_SharedMemoryProcess, self).run()
+
+    def _put(self, input):
+        slot = self._free_slots.get(block=True)
+        self._slots[slot][...] = input
+        self._queue.put(slot, block=True)
+
 
 class Sampler(object):
+    """ runs generate_batch in worker processes and hands out the batches through a queue
+
+    workers are seeded with seed + worker index (+ restart generation) so that they produce different,
+    reproducible streams. dead workers are restarted by next_batch, which raises SamplerTimeoutError when
+    no batch arrives within timeout seconds, and RuntimeError when more than max_restarts restarts happen within
+    restart_window_seconds (a worker that keeps crashing).
+
+    a worker that dies while writing may leave the queue locked, so one dead worker restarts all workers on fresh
+    channels: the batches queued at that moment are dropped, and the workers continue with new seeds.
+    """
+
+    _poll_interval = 1.0
 
-    def __init__(self, generate_batch, num_process=None):
+    def __init__(self, generate_batch, num_process=None, seed=None, timeout=None, max_restarts=10,
+                 restart_window_seconds=600):
         self._queue = None
         self._runner_list = []
         self._start = False
@@ -27,30 +85,219 @@ class Sampler(object):
         else:
             self._num_process = num_process
 
+        if seed is None:
+            seed = int.from_bytes(os.urandom(4), 'little')
+
+        self._seed = seed
+        self._timeout = timeout
+        self._max_restarts = max_restarts
+        self._restart_window_seconds = restart_window_seconds
+        self._generations = [0] * self._num_process
+        self._restart_count = 0
+        self._restart_times = deque()
+
+        self._batch_count = 0
+        self._wait_seconds = 0.0
+        self._start_time = None
+
         self._generate_batch = generate_batch
 
-    def next_batch(self):
+    @property
+    def seed(self):
+        return self._seed
+
+    @property
+    def restart_count(self):
+        return self._restart_count
+
+    @property
+    def batch_count(self):
+        return self._batch_count
+
+    def stats(self):
+        elapsed = 0.0 if self._start_time is None else time.time() - self._start_time
+        return {
+            'batch_count': self._batch_count,
+            'batches_per_second': self._batch_count / elapsed if elapsed > 0 else 0.0,
+            'wait_seconds': self._wait_seconds,
+            'restart_count': self._restart_count,
+            'alive_workers': sum(runner.is_alive() for runner in self._runner_list)
+        }
+
+    def next_batch(self, timeout=None):
         if not self._start:
             self._reset()
+        else:
+            self._check_workers()
 
-        return self._queue.get(block=True)
+        if timeout is None:
+            timeout = self._timeout
 
-    def _reset(self):
+        start = time.time()
+        while True:
+            try:
+                input = self._get(self._poll_interval)
+                break
+            except queue.Empty:
+                self._check_workers()
+                if timeout is not None and time.time() - start > timeout:
+                    self._wait_seconds += time.time() - start
+                    raise SamplerTimeoutError(f'no batch within {timeout} seconds')
+
+        self._wait_seconds += time.time() - start
+        self._batch_count += 1
+        return input
+
+    def batches(self):
+        while True:
+            yield self.next_batch()
+
+    def _get(self, timeout):
+        return self._queue.get(block=True, timeout=timeout)
+
+    def _check_workers(self):
+        dead = [ind for ind, runner in enumerate(self._runner_list) if not runner.is_alive()]
+        if len(dead) == 0:
+            return
+
+        now = time.time()
+        while len(self._restart_times) > 0 and now - self._restart_times[0] > self._restart_window_seconds:
+            self._restart_times.popleft()
+
+        for ind in dead:
+            exitcode = self._runner_list[ind].exitcode
+            if len(self._restart_times) >= self._max_restarts:
+                raise RuntimeError(f'sampler worker {ind} died (exitcode {exitcode}) after {self._max_restarts} '
+                                   f'restarts within {self._restart_window_seconds} seconds')
+
+            print(f'sampler worker {ind} died (exitcode {exitcode}), restarting all workers')
+            self._restart_times.append(now)
+            self._restart_count += 1
+
+        self._restart_workers(dead)
 
+    def _restart_workers(self, dead):
+        # a worker that died while writing may leave the queue locked (or keep a shared slot),
+        # so restart all workers on fresh channels, with new seeds so that no batch is replayed.
+        # batches still queued in the old channels are lost
+        del dead
+        self._generations = [generation + 1 for generation in self._generations]
+        self._reset()
+
+    def _create_channels(self):
+        self._queue = Queue(maxsize=self._num_process)
+
+    def _create_runner(self, ind):
+        seed = _worker_seed(self._seed, ind, self._generations[ind])
+        return _Process(self._queue, self._generate_batch, seed)
+
+    def _terminate_runners(self):
         while len(self._runner_list) > 0:
             runner = self._runner_list.pop()
             runner.terminate()
+            runner.join()
             del runner
 
+    def _reset(self):
+
+        self._terminate_runners()
+
         if self._queue is not None:
             del self._queue
 
-        self._queue = Queue(maxsize=self._num_process)
+        self._create_channels()
 
         for ind in range(self._num_process):
-            runner = _Process(self._queue, self._generate_batch)
-            runner.deamon = True
+            runner = self._create_runner(ind)
             self._runner_list.append(runner)
             runner.start()
 
         self._start = True
+        self._start_time = time.time()
+
+    def close(self):
+        self._terminate_runners()
+        self._queue = None
+        self._start = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BatchHandle(object):
+
+    def __init__(self, free_slots, slot):
+        self._free_slots = free_slots
+        self._slot = slot
+
+    def release(self):
+        if self._slot is not None:
+            self._free_slots.put(self._slot)
+            self._slot = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class SharedMemorySampler(Sampler):
+    """ workers write batches in place into a ring of shared buffers, next_batch returns (view, handle)
+
+    the view is valid until handle.release() is called, after which the slot is reused by the workers
+    """
+
+    def __init__(self, generate_batch, dtype, batch_size, num_process=None, num_slots=None, seed=None,
+                 timeout=None, max_restarts=10, restart_window_seconds=600):
+        self._free_slots = None
+        self._buffers = []
+        self._slots = []
+
+        super(SharedMemorySampler, self).__init__(generate_batch=generate_batch,
+                                                  num_process=num_process,
+                                                  seed=seed,
+                                                  timeout=timeout,
+                                                  max_restarts=max_restarts,
+                                                  restart_window_seconds=restart_window_seconds)
+
+        if num_slots is None:
+            self._num_slots = 2 * self._num_process + 1
+        else:
+            self._num_slots = num_slots
+
+        self._dtype = np.dtype(dtype)
+        self._batch_size = batch_size
+
+    def batches(self):
+        """ yields views only, each slot is released when the consumer asks for the next batch"""
+        while True:
+            batch, handle = self.next_batch()
+            yield batch
+            handle.release()
+
+    def _get(self, timeout):
+        slot = self._queue.get(block=True, timeout=timeout)
+        return self._slots[slot], BatchHandle(self._free_slots, slot)
+
+    def _create_channels(self):
+        nbytes = self._dtype.itemsize * self._batch_size
+        self._buffers = [RawArray(ctypes.c_byte, nbytes) for _ in range(self._num_slots)]
+        self._slots = [np.frombuffer(buffer, dtype=self._dtype, count=self._batch_size) for buffer in self._buffers]
+
+        self._free_slots = Queue()
+        self._queue = Queue()
+        for slot in range(self._num_slots):
+            self._free_slots.put(slot)
+
+    def _create_runner(self, ind):
+        seed = _worker_seed(self._seed, ind, self._generations[ind])
+        return _SharedMemoryProcess(self._free_slots, self._queue, self._buffers,
+                                    self._dtype, self._batch_size, self._generate_batch, seed)
+
+    def close(self):
+        super(SharedMemorySampler, self).close()
+        self._free_slots = None
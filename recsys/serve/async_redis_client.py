@@ -0,0 +1,43 @@
+import redis.asyncio
+
+from recsys.serve.redis_client import RedisClient
+
+
+class AsyncRedisClient(RedisClient):
+    """ the read side of RedisClient for asyncio servers, commands are queued the same way and awaited on execute"""
+
+    def __init__(self, redis_connection_config,
+                 max_seq_len=5,
+                 expire_time_seconds=20):
+
+        super(AsyncRedisClient, self).__init__(redis_connection_config,
+                                               max_seq_len=max_seq_len,
+                                               expire_time_seconds=expire_time_seconds)
+
+        # asyncio connections can not share the pool of the blocking client
+        self._redis_db = redis.asyncio.Redis(host=redis_connection_config._host,
+                                             port=redis_connection_config._port,
+                                             db=redis_connection_config._db,
+                                             password=redis_connection_config._password)
+
+    async def get_history(self, key):
+        pipeline = self._redis_db.pipeline(transaction=False)
+        self._queue_lrange(pipeline, key)
+        return (await pipeline.execute())[-1]
+
+    async def mget_histories(self, keys):
+        pipeline = self._redis_db.pipeline(transaction=False)
+        for key in keys:
+            self._queue_lrange(pipeline, key)
+
+        results = await pipeline.execute()
+        if self._expire_time_seconds is not None:
+            results = results[1::2]
+
+        return results
+
+    async def get_recommendations(self, key):
+        return [itemId.decode("utf-8") for itemId in await self._redis_db.lrange(key, 0, -1)]
+
+    async def close(self):
+        await self._redis_db.close()
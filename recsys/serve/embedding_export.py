@@ -0,0 +1,72 @@
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'RECEMB01'
+_header_length = struct.Struct('<I')
+
+
+def iter_embedding_export(get_embeddings, start, stop, dim, model_version, get_itemIds=None, chunk_size=65536):
+    """ yields the binary export of items start <= item_index < stop in chunks
+
+    layout: MAGIC, uint32 header length, utf-8 json header (dim, count, start, stop, dtype, model_version,
+    has_itemIds), count x dim little endian float32 rows, then one utf-8 itemId per line if has_itemIds.
+    get_embeddings(start, stop) and get_itemIds(start, stop) return the rows of one chunk, so at most chunk_size
+    rows are in memory.
+    """
+    header = {
+        'dim': int(dim),
+        'count': int(stop - start),
+        'start': int(start),
+        'stop': int(stop),
+        'dtype': '<f4',
+        'model_version': model_version,
+        'has_itemIds': get_itemIds is not None
+    }
+    header = json.dumps(header).encode('utf-8')
+
+    yield MAGIC + _header_length.pack(len(header)) + header
+
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        yield np.ascontiguousarray(get_embeddings(chunk_start, chunk_stop), dtype='<f4').tobytes()
+
+    if get_itemIds is not None:
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            yield ''.join(f'{itemId}\n' for itemId in get_itemIds(chunk_start, chunk_stop)).encode('utf-8')
+
+
+def write_embedding_export(path, get_embeddings, start, stop, dim, model_version, get_itemIds=None,
+                           chunk_size=65536):
+    with open(path, 'wb') as f:
+        for chunk in iter_embedding_export(get_embeddings, start, stop, dim, model_version,
+                                           get_itemIds=get_itemIds, chunk_size=chunk_size):
+            f.write(chunk)
+
+
+def read_embedding_export(path, mmap_mode='r'):
+    """ returns (header, embeddings, itemIds), embeddings are memory-mapped unless mmap_mode is None"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not an embedding export')
+
+        header_length, = _header_length.unpack(f.read(_header_length.size))
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        offset = f.tell()
+
+        shape = (header['count'], header['dim'])
+        if shape[0] == 0:
+            embeddings = np.zeros(shape, dtype=header['dtype'])
+        elif mmap_mode is None:
+            embeddings = np.fromfile(f, dtype=header['dtype'], count=shape[0] * shape[1]).reshape(shape)
+        else:
+            embeddings = np.memmap(path, dtype=header['dtype'], mode=mmap_mode, offset=offset, shape=shape)
+
+        itemIds = None
+        if header['has_itemIds']:
+            f.seek(offset + shape[0] * shape[1] * np.dtype(header['dtype']).itemsize)
+            itemIds = f.read().decode('utf-8').splitlines()
+
+    return header, embeddings, itemIds
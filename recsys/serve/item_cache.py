@@ -0,0 +1,52 @@
+from recsys.serve.lru_cache import LRUCache
+
+
+class ItemInfoCache(object):
+    """ item metadata (itemId, itemName, item_index, url) served from memory, misses are fetched from mongodb"""
+
+    def __init__(self, mongo_client, max_size=100000, ttl_seconds=3600):
+        self._mongo = mongo_client
+        self._cache = LRUCache(max_size=max_size, ttl_seconds=ttl_seconds)
+
+    def put(self, item_info):
+        self._cache.put(item_info['itemId'], item_info)
+
+    def get_item_info(self, itemIds):
+        """ item infos in request order without duplicates, unknown itemIds are dropped"""
+        itemIds, item_infos, missing = self.lookup(itemIds)
+
+        if len(missing) > 0:
+            self.add_fetched(item_infos, self._mongo.get_item_info(missing))
+
+        return [item_infos[itemId] for itemId in itemIds if itemId in item_infos]
+
+    def lookup(self, itemIds):
+        """ (deduplicated itemIds, {itemId: cached item info}, missing itemIds) without touching mongodb
+
+        lets callers with their own mongodb client (e.g. an asyncio one) fetch the misses, see add_fetched
+        """
+        itemIds = list(dict.fromkeys(itemIds))
+
+        item_infos = dict()
+        missing = []
+        for itemId in itemIds:
+            item_info = self._cache.get(itemId)
+            if item_info is None:
+                missing.append(itemId)
+            else:
+                item_infos[itemId] = item_info
+
+        return itemIds, item_infos, missing
+
+    def add_fetched(self, item_infos, fetched):
+        for item_info in fetched:
+            self.put(item_info)
+            item_infos[item_info['itemId']] = item_info
+
+    def refresh(self):
+        self._cache.clear()
+        for item_info in self._mongo.get_all_item_info():
+            self.put(item_info)
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,140 @@
+import os
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+    """ thread safe latency histogram with fixed upper bounds (seconds)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        ind = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[ind] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """ ([(upper bound, cumulative count), ..., ('+Inf', count)], sum, count)"""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+
+        cumulative = []
+        acc = 0
+        for bound, bucket_count in zip(self._buckets + ('+Inf',), counts):
+            acc += bucket_count
+            cumulative.append((bound, acc))
+
+        return cumulative, total, count
+
+    def quantile(self, q):
+        """ upper bound of the bucket holding the q-quantile"""
+        cumulative, _, count = self.snapshot()
+        if count == 0:
+            return None
+
+        for bound, acc in cumulative:
+            if acc >= q * count:
+                return bound
+
+
+class Metrics(object):
+    """ per-stage latency histograms and labelled counters, rendered in the prometheus text format
+
+    gauges that are only known at scrape time (cache hit rates, model version) are passed to render.
+    every series carries a worker label (the pid of the process that renders it): under a multi-worker server
+    each scrape reaches one worker, and the label keeps those series apart so that they can be summed up.
+    """
+
+    def __init__(self, prefix='recsys', buckets=DEFAULT_BUCKETS, worker_label=True):
+        self._prefix = prefix
+        self._worker_label = worker_label
+        self._buckets = buckets
+        self._histograms = defaultdict(lambda: Histogram(self._buckets))
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms[stage]
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def stats(self):
+        """ count and approximate p50/p99 per stage, for /info"""
+        with self._lock:
+            histograms = dict(self._histograms)
+
+        return {stage: {'count': histogram.snapshot()[2],
+                        'p50': histogram.quantile(0.5),
+                        'p99': histogram.quantile(0.99)}
+                for stage, histogram in histograms.items()}
+
+    def render(self, gauges=None):
+        """ gauges: [(name, {label: value}, value), ...]"""
+        with self._lock:
+            histograms = dict(self._histograms)
+            counters = dict(self._counters)
+
+        # the pid is taken here, not in __init__, a preloaded server creates Metrics before forking its workers
+        worker = {'worker': str(os.getpid())} if self._worker_label else {}
+
+        lines = []
+
+        name = f'{self._prefix}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for stage in sorted(histograms):
+            cumulative, total, count = histograms[stage].snapshot()
+            for bound, acc in cumulative:
+                lines.append(f'{name}_bucket{_format_labels(dict(worker, stage=stage, le=bound))} {acc}')
+            lines.append(f'{name}_sum{_format_labels(dict(worker, stage=stage))} {total}')
+            lines.append(f'{name}_count{_format_labels(dict(worker, stage=stage))} {count}')
+
+        for counter_name in sorted({counter_name for counter_name, _ in counters}):
+            lines.append(f'# TYPE {self._prefix}_{counter_name} counter')
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == counter_name:
+                    lines.append(f'{self._prefix}_{counter_name}{_format_labels(dict(worker, **dict(labels)))} {value}')
+
+        typed = set()
+        for gauge_name, labels, value in gauges or []:
+            if value is None:
+                continue
+
+            if gauge_name not in typed:
+                lines.append(f'# TYPE {self._prefix}_{gauge_name} gauge')
+                typed.add(gauge_name)
+            lines.append(f'{self._prefix}_{gauge_name}{_format_labels(dict(worker, **labels))} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
@@ -0,0 +1,113 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    """ coalesces concurrent submit() calls into one process_batch(items) call
+
+    a batch is closed when it reaches max_batch_size or max_wait_seconds after its first item arrived.
+    process_batch must return one result per item, in order.
+    the worker thread is started on first use in every process, so a batcher created before a fork (e.g. in a
+    preloaded gunicorn master) works in the forked workers.
+    """
+
+    def __init__(self, process_batch, max_batch_size=64, max_wait_seconds=0.005):
+        self._process_batch = process_batch
+        self._max_batch_size = max_batch_size
+        self._max_wait_seconds = max_wait_seconds
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _ensure_started(self):
+        # threads do not survive fork(), a forked process starts its own
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, args=(self._queue,), name='micro_batcher',
+                                                daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def submit(self, item):
+        if self._closed:
+            raise RuntimeError('micro batcher is closed')
+
+        self._ensure_started()
+
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item, timeout=None):
+        return self.submit(item).result(timeout=timeout)
+
+    def close(self):
+        self._closed = True
+        if self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _next_batch(self, batch_queue):
+        first = batch_queue.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.time() + self._max_wait_seconds
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                entry = batch_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if entry is None:
+                batch_queue.put(None)
+                break
+
+            batch.append(entry)
+
+        return batch
+
+    def _run(self, batch_queue):
+        while True:
+            batch = self._next_batch(batch_queue)
+            if batch is None:
+                return
+
+            # callers that gave up (e.g. asyncio.wait_for cancelled the future) are dropped
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+
+            items = [item for item, _ in batch]
+            try:
+                results = self._process_batch(items)
+            except Exception as e:
+                for _, future in batch:
+                    self._set(future.set_exception, e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                self._set(future.set_result, result)
+
+    @staticmethod
+    def _set(setter, value):
+        # a failing setter (future already resolved) must not kill the batcher thread
+        try:
+            setter(value)
+        except Exception as e:
+            print(f'micro batcher could not resolve a future: {e!r}')
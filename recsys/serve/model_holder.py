@@ -0,0 +1,174 @@
+import time
+import threading
+from contextlib import contextmanager
+
+
+class ModelHolder(object):
+    """ double-buffered serving model
+
+    load_model(current model or None) builds a model next to the live one (its own graph, session and index),
+    warm_up(model) runs it once, and only then the reference is swapped. readers take one model per request
+    with use() (or acquire/release, e.g. around a streamed response) and keep that reference, so a request never
+    mixes two models. close_model(old model) is called once the old model is swapped out and its last user has
+    released it.
+
+    get_version(model) returns something that changes whenever the files load_model reads change. reload only
+    reaches the process it is called in, watch polls get_version so that every serving process (e.g. every
+    gunicorn worker) reloads by itself when new files are published.
+    """
+
+    def __init__(self, load_model, warm_up=None, close_model=None, get_version=None):
+        self._load_model = load_model
+        self._warm_up = warm_up
+        self._close_model = close_model
+        self._get_version = get_version
+
+        self._model = None
+        self._version = None
+        # model -> number of requests using it
+        self._users = dict()
+        self._users_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._reload_thread = None
+        self._watch_thread = None
+
+        self._reload_count = 0
+        self._last_reload_seconds = None
+        self._last_error = None
+
+    @property
+    def model(self):
+        return self._model
+
+    def acquire(self, model=None):
+        """ register one more user of model (the live model by default) and return it, see release"""
+        with self._users_lock:
+            if model is None:
+                model = self._model
+            self._users[model] = self._users.get(model, 0) + 1
+            return model
+
+    def release(self, model):
+        with self._users_lock:
+            count = self._users[model] - 1
+            if count > 0:
+                self._users[model] = count
+                return
+
+            del self._users[model]
+            retired = model is not self._model
+
+        if retired:
+            self._close(model)
+
+    @contextmanager
+    def use(self):
+        model = self.acquire()
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def _close(self, model):
+        if self._close_model is None:
+            return
+
+        try:
+            self._close_model(model)
+        except Exception as e:
+            print(f'closing a model failed: {e!r}')
+
+    @property
+    def is_reloading(self):
+        return self._reload_thread is not None and self._reload_thread.is_alive()
+
+    def load(self):
+        """ load, warm up and swap in a new model in the calling thread"""
+        start = time.time()
+        # taken before loading, files published while loading trigger another reload
+        version = self._current_version(self._model)
+
+        model = self._load_model(self._model)
+        if self._warm_up is not None:
+            self._warm_up(model)
+
+        with self._users_lock:
+            old_model = self._model
+            self._model = model
+            unused = old_model is not None and old_model not in self._users
+        self._version = self._current_version(model) if version is None else version
+
+        # otherwise the last release closes it
+        if unused:
+            self._close(old_model)
+        self._reload_count += 1
+        self._last_reload_seconds = time.time() - start
+        self._last_error = None
+
+        return model
+
+    def reload(self):
+        """ start loading a new model in the background, returns False if a reload is already running"""
+        with self._lock:
+            if self.is_reloading:
+                return False
+
+            self._reload_thread = threading.Thread(target=self._reload, daemon=True)
+            self._reload_thread.start()
+            return True
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            # the live model keeps serving
+            self._last_error = repr(e)
+            print(f'model reload failed: {self._last_error}')
+
+    def _current_version(self, model):
+        if self._get_version is None or model is None:
+            return None
+
+        return self._get_version(model)
+
+    def watch(self, interval_seconds=10):
+        """ reload in the background whenever get_version changes, in the calling process only
+
+        threads do not survive a fork, call it in every worker after forking
+        """
+        if self._get_version is None:
+            raise ValueError('watch needs get_version')
+
+        if self._watch_thread is not None and self._watch_thread.is_alive():
+            return
+
+        self._watch_thread = threading.Thread(target=self._watch, args=(interval_seconds,), daemon=True)
+        self._watch_thread.start()
+
+    def _watch(self, interval_seconds):
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                version = self._current_version(self._model)
+            except Exception as e:
+                print(f'model version check failed: {e!r}')
+                continue
+
+            if version != self._version and not self.is_reloading:
+                # a failed reload is not retried until the files change again
+                self._version = version
+                self.reload()
+
+    def wait(self, timeout=None):
+        thread = self._reload_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        return {
+            'reloading': self.is_reloading,
+            'reload_count': self._reload_count,
+            'version': self._version,
+            'last_reload_seconds': self._last_reload_seconds,
+            'last_error': self._last_error
+        }
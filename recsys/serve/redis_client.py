@@ -1,4 +1,4 @@
-from types import *
+import threading
 
 import redis
 
@@ -12,16 +12,31 @@ class RedisConnectionConfig(object):
         self._password = password
 
 
+_connection_pools = dict()
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(redis_connection_config):
+    """ one connection pool per server, shared by every RedisClient of the process"""
+    key = (redis_connection_config._host, redis_connection_config._port,
+           redis_connection_config._db, redis_connection_config._password)
+
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = redis.ConnectionPool(host=redis_connection_config._host,
+                                                          port=redis_connection_config._port,
+                                                          db=redis_connection_config._db,
+                                                          password=redis_connection_config._password)
+        return _connection_pools[key]
+
+
 class RedisClient(object):
 
     def __init__(self, redis_connection_config,
                  max_seq_len=5,
                  expire_time_seconds=20):
 
-        self._redis_db = redis.Redis(host=redis_connection_config._host,
-                                     port=redis_connection_config._port,
-                                     db=redis_connection_config._db,
-                                     password=redis_connection_config._password)
+        self._redis_db = redis.Redis(connection_pool=get_connection_pool(redis_connection_config))
         self._max_seq_len = max_seq_len
         self._expire_time_seconds = expire_time_seconds
 
@@ -32,29 +47,71 @@ class RedisClient(object):
         return self._lrange(key)
 
     def _lpush(self, key, value):
+        pipeline = self._redis_db.pipeline(transaction=True)
+        self._queue_lpush(pipeline, key, value)
+        pipeline.execute()
+
+    def _queue_lpush(self, pipeline, key, value):
         if isinstance(value, list):
-            len = self._redis_db.lpush(key, *value)
+            pipeline.lpush(key, *value)
         else:
-            len = self._redis_db.lpush(key, value)
+            pipeline.lpush(key, value)
 
-        self._sustain_seq_len(len, self._max_seq_len)
-        self._set_expire(key)
+        self._queue_sustain_seq_len(pipeline, key)
+        self._queue_set_expire(pipeline, key)
 
-    def _sustain_seq_len(self, key, current_len):
+    def _queue_sustain_seq_len(self, pipeline, key):
         if self._max_seq_len is None:
             return
 
-        difference = current_len - self._max_seq_len
-        if difference > 0:
-            self._redis_db.ltrim(key, 0, self._max_seq_len - 1)
+        pipeline.ltrim(key, 0, self._max_seq_len - 1)
 
     def _lrange(self, key):
-        self._set_expire(key)
-        return self._redis_db.lrange(key, 0, self._max_seq_len - 1)
+        pipeline = self._redis_db.pipeline(transaction=False)
+        self._queue_lrange(pipeline, key)
+        return pipeline.execute()[-1]
+
+    def _queue_lrange(self, pipeline, key):
+        self._queue_set_expire(pipeline, key)
+        stop = -1 if self._max_seq_len is None else self._max_seq_len - 1
+        pipeline.lrange(key, 0, stop)
+
+    def _queue_set_expire(self, pipeline, key):
+        if self._expire_time_seconds is not None:
+            pipeline.expire(key, self._expire_time_seconds)
+
+    def mget_histories(self, keys):
+        """ histories of many keys (newest first, like __getitem__) in one round trip"""
+        pipeline = self._redis_db.pipeline(transaction=False)
+        for key in keys:
+            self._queue_lrange(pipeline, key)
 
-    def _set_expire(self, key):
+        results = pipeline.execute()
         if self._expire_time_seconds is not None:
-            self._redis_db.expire(key, self._expire_time_seconds)
+            results = results[1::2]
+
+        return results
+
+    def push_many(self, items):
+        """ push {key: value or [values]} for many keys in one round trip"""
+        pipeline = self._redis_db.pipeline(transaction=False)
+        for key, value in items.items():
+            self._queue_lpush(pipeline, key, value)
+        pipeline.execute()
+
+    def set_recommendations(self, recommendations, expire_time_seconds=None):
+        """ write {key: [itemId, ...]} in one pipelined round trip"""
+        pipeline = self._redis_db.pipeline(transaction=False)
+        for key, itemIds in recommendations.items():
+            pipeline.delete(key)
+            if len(itemIds) > 0:
+                pipeline.rpush(key, *itemIds)
+            if expire_time_seconds is not None:
+                pipeline.expire(key, expire_time_seconds)
+        pipeline.execute()
+
+    def get_recommendations(self, key):
+        return [itemId.decode("utf-8") for itemId in self._redis_db.lrange(key, 0, -1)]
 
     def flushall(self):
         self._redis_db.flushall()
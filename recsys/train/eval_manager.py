@@ -1,4 +1,4 @@
-import numpy as np
+from recsys.ranking import rank_above as count_rank_above
 
 
 class EvalManager(object):
@@ -18,11 +18,6 @@ class EvalManager(object):
         return results, rank_above
 
     def _full_rank(self, pos_sample, predictions):
-        rank_above = 0
-        pos_prediction = predictions[pos_sample]
+        rank_above = count_rank_above(predictions, pos_sample)
 
-        for ind in range(len(predictions)):
-            if pos_prediction < predictions[ind]:
-                rank_above += 1
-
-        return rank_above, len(predictions)
+        return rank_above, predictions.shape[-1]
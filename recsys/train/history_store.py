@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+
+
+class HistoryStore(object):
+    """ user histories in CSR layout: items[offsets[u]:offsets[u + 1]] are the item indices of user u"""
+
+    _offsets_filename = 'offsets.npy'
+    _items_filename = 'items.npy'
+
+    def __init__(self, store_dir):
+        self._store_dir = store_dir
+        self._offsets = np.load(os.path.join(store_dir, self._offsets_filename), mmap_mode='r')
+        self._items = np.load(os.path.join(store_dir, self._items_filename), mmap_mode='r')
+
+    @property
+    def offsets(self):
+        return self._offsets
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def total_users(self):
+        return len(self._offsets) - 1
+
+    def lengths(self):
+        return np.diff(self._offsets)
+
+    def get_history(self, user_index):
+        return self._items[self._offsets[user_index]:self._offsets[user_index + 1]]
+
+    @classmethod
+    def exists(cls, store_dir):
+        return os.path.exists(os.path.join(store_dir, cls._offsets_filename)) and \
+               os.path.exists(os.path.join(store_dir, cls._items_filename))
+
+    @classmethod
+    def invalidate(cls, store_dir):
+        """ drop a store whose histories changed in mongodb, the next use_history_store exports it again"""
+        offsets_path = os.path.join(store_dir, cls._offsets_filename)
+        if os.path.exists(offsets_path):
+            os.remove(offsets_path)
+
+    @classmethod
+    def export(cls, mongo_client, store_dir, batch_size=10000):
+        os.makedirs(store_dir, exist_ok=True)
+
+        projection = {
+            '_id': 0,
+            'user_index': 1,
+            'sorted_items': 1
+        }
+
+        total_users = mongo_client.total_users
+        lengths = np.zeros(total_users, dtype=np.int64)
+        raw_items_path = os.path.join(store_dir, 'items.bin')
+
+        with open(raw_items_path, 'wb') as f:
+            next_user = 0
+            for start in range(0, total_users, batch_size):
+                stop = start + batch_size
+                cursor = mongo_client.db.users.find({'user_index': {'$gte': start, '$lt': stop}}, projection)
+
+                for doc in cursor.sort('user_index', 1):
+                    user_index = doc['user_index']
+                    if user_index < next_user or user_index >= total_users:
+                        continue
+
+                    history = mongo_client.item_index.to_index(doc['sorted_items'], unknown='skip')
+                    history.astype(np.int32).tofile(f)
+                    lengths[user_index] = len(history)
+                    next_user = user_index + 1
+
+        offsets = np.zeros(total_users + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        np.save(os.path.join(store_dir, cls._offsets_filename), offsets)
+
+        items_path = os.path.join(store_dir, cls._items_filename)
+        total_items = int(offsets[-1])
+        if total_items == 0:
+            np.save(items_path, np.zeros(0, dtype=np.int32))
+        else:
+            raw_items = np.memmap(raw_items_path, dtype=np.int32, mode='r', shape=(total_items,))
+            items = np.lib.format.open_memmap(items_path, mode='w+', dtype=np.int32, shape=(total_items,))
+            chunk_size = 1 << 22
+            for start in range(0, len(items), chunk_size):
+                items[start:start + chunk_size] = raw_items[start:start + chunk_size]
+            items.flush()
+            del items, raw_items
+        os.remove(raw_items_path)
+
+        return cls(store_dir)
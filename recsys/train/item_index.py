@@ -0,0 +1,157 @@
+import os
+import json
+
+import numpy as np
+
+from recsys import versioned_dir
+
+
+class ItemIndex(object):
+    """ itemId <-> item_index mapping backed by numpy arrays
+
+    itemIds[i] is the itemId of item_index i, sorted_itemIds/sorted_indices allow lookups with searchsorted.
+    the arrays are saved as .npy files so that they can be memory-mapped at startup. every save publishes a new
+    version directory (see versioned_dir), mapped files of a live index are never rewritten.
+    """
+
+    format_version = 1
+
+    _meta_filename = 'meta.json'
+    _array_names = ('itemIds', 'sorted_itemIds', 'sorted_indices')
+
+    def __init__(self, itemIds, sorted_itemIds, sorted_indices, version=1):
+        self._itemIds = itemIds
+        self._sorted_itemIds = sorted_itemIds
+        self._sorted_indices = sorted_indices
+        self._version = version
+
+    @classmethod
+    def from_pairs(cls, pairs, version=1):
+        """ build from (itemId, item_index) pairs"""
+        pairs = list(pairs)
+        total_items = max([index for _, index in pairs], default=-1) + 1
+
+        itemIds = [''] * total_items
+        for itemId, index in pairs:
+            itemIds[index] = itemId
+        itemIds = np.array(itemIds, dtype=np.str_)
+
+        sorted_indices = np.argsort(itemIds, kind='stable')
+        sorted_indices = sorted_indices[itemIds[sorted_indices] != '']
+
+        return cls(itemIds, itemIds[sorted_indices], sorted_indices.astype(np.int64), version=version)
+
+    @property
+    def version(self):
+        return self._version
+
+    def __len__(self):
+        return len(self._itemIds)
+
+    def _lookup(self, itemIds):
+        itemIds = np.asarray(itemIds, dtype=np.str_)
+        if len(self._sorted_itemIds) == 0:
+            return np.zeros(itemIds.shape, dtype=np.int64), np.zeros(itemIds.shape, dtype=bool)
+
+        pos = np.searchsorted(self._sorted_itemIds, itemIds)
+        pos = np.minimum(pos, len(self._sorted_itemIds) - 1)
+        found = self._sorted_itemIds[pos] == itemIds
+        return np.asarray(self._sorted_indices[pos]), found
+
+    def to_index(self, itemIds, unknown='error', oov_index=-1):
+        """ vectorized itemId -> item_index
+
+        unknown itemIds are dropped ('skip'), mapped to oov_index ('oov') or raise KeyError ('error')
+        """
+        indices, found = self._lookup(itemIds)
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if np.all(found):
+            return indices
+
+        if unknown == 'skip':
+            return indices[found]
+        elif unknown == 'oov':
+            return np.where(found, indices, oov_index)
+        elif unknown == 'error':
+            raise KeyError(np.asarray(itemIds)[~found].tolist())
+        else:
+            raise ValueError(f'Invalid unknown itemId handling: {unknown}')
+
+    def to_itemId(self, indices):
+        """ vectorized item_index -> itemId"""
+        return self._itemIds[np.asarray(indices, dtype=np.int64)].tolist()
+
+    def has_itemId(self, itemId):
+        _, found = self._lookup(itemId)
+        return bool(found)
+
+    def get_index(self, itemId):
+        index, found = self._lookup(itemId)
+        if not found:
+            raise KeyError(itemId)
+
+        return int(index)
+
+    def get_itemId(self, index):
+        return str(self._itemIds[index])
+
+    @classmethod
+    def _version_dir(cls, index_dir):
+        current = versioned_dir.current_dir(index_dir)
+        # indexes saved before versioning keep their files directly in index_dir
+        return index_dir if current is None else current
+
+    @classmethod
+    def exists(cls, index_dir):
+        return os.path.exists(os.path.join(cls._version_dir(index_dir), cls._meta_filename))
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        version_dir = versioned_dir.new_version_dir(index_dir)
+
+        for name in self._array_names:
+            np.save(os.path.join(version_dir, name + '.npy'), getattr(self, '_' + name))
+
+        meta = {
+            'format_version': self.format_version,
+            'version': self._version,
+            'total_items': len(self)
+        }
+        with open(os.path.join(version_dir, self._meta_filename), 'w') as f:
+            json.dump(meta, f)
+
+        versioned_dir.publish(index_dir, version_dir)
+
+    @classmethod
+    def read_meta(cls, index_dir):
+        with open(os.path.join(cls._version_dir(index_dir), cls._meta_filename), 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def invalidate(cls, index_dir):
+        """ mark a persisted index stale (e.g. after ingesting new items), load then raises so that it is rebuilt"""
+        if not cls.exists(index_dir):
+            return
+
+        meta = cls.read_meta(index_dir)
+        meta['stale'] = True
+
+        meta_path = os.path.join(cls._version_dir(index_dir), cls._meta_filename)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode='r'):
+        version_dir = cls._version_dir(index_dir)
+        meta = cls.read_meta(index_dir)
+
+        if meta['format_version'] != cls.format_version:
+            raise ValueError(f'item index format {meta["format_version"]} is not {cls.format_version}')
+
+        if meta.get('stale', False):
+            raise ValueError('item index is stale')
+
+        arrays = [np.load(os.path.join(version_dir, name + '.npy'), mmap_mode=mmap_mode) for name in cls._array_names]
+        return cls(*arrays, version=meta['version'])
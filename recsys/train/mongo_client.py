@@ -1,9 +1,11 @@
 import os
+import copy
 import random
 
 import pymongo
 
 from recsys.samplers.sampler import Sampler
+from recsys.train.item_index import ItemIndex
 
 
 class MongoConfig(object):
@@ -50,14 +52,19 @@ class MongoClient(object):
 
         self._db_name = db_name
         self._db = self._client.__getattr__(db_name)
-        self._total_items = self._db.items.count()
-        self._total_users = self._db.users.count()
 
-        if self._total_items < 0 or self._total_users < 0:
-            raise ValueError("Invalid database")
+        # counted on first use, a server loading a persisted item index never needs them
+        self._total_items = None
+        self._total_users = None
 
-        self._itemId_to_index = dict()
-        self._index_to_itemId = dict()
+        self._item_index = ItemIndex.from_pairs([])
+
+    def share(self):
+        """ a client on the same connection with its own item index and counts"""
+        client = copy.copy(self)
+        client._total_items = None
+        client._total_users = None
+        return client
 
     @property
     def db(self):
@@ -81,25 +88,47 @@ class MongoClient(object):
             print('New process connected to mongodb')
             return self._db
 
-    def load_item_index(self):
+    def load_item_index(self, item_info_callback=None, version=1):
+        """ build the item index from a scan of the items collection"""
         projection = {
             '_id': 0,
             'item_index': 1,
             'itemName': 1,
-            'itemId': 1
+            'itemId': 1,
+            'url': 1
+        }
+
+        pairs = []
+        for doc in self.db.items.find({}, projection):
+            pairs.append((doc['itemId'], doc['item_index']))
+
+            if item_info_callback is not None:
+                item_info_callback(doc)
+
+        self._item_index = ItemIndex.from_pairs(pairs, version=version)
+        return self._item_index
+
+    @property
+    def item_index(self):
+        return self._item_index
+
+    @item_index.setter
+    def item_index(self, value):
+        self._item_index = value
+
+    def export_item_label_tsv(self, tsv_file_path='item_label.tsv'):
+        projection = {
+            '_id': 0,
+            'item_index': 1,
+            'itemName': 1
         }
-        tsv_file_path = 'item_label.tsv'
 
         with open(tsv_file_path, 'w') as f:
             f.write("Index\tLabel\n")
-            for doc in self.db.items.find({}, projection):
-                self._itemId_to_index[doc['itemId']] = doc['item_index']
-                self._index_to_itemId[doc['item_index']] = doc['itemId']
+            for doc in self.db.items.find({}, projection).sort('item_index', 1):
                 f.write("{}\t{}\n".format(doc['item_index'], doc['itemName']))
 
-
-    def get_item_info(self, itemIds):
-
+    def get_all_item_info(self):
         projection = {
             '_id': 0,
             'itemId': 1,
@@ -108,9 +137,35 @@ class MongoClient(object):
             'url': 1
         }
 
+        return self.db.items.find({}, projection)
+
+    def get_item_counts(self):
+        projection = {
+            '_id': 0,
+            'item_index': 1,
+            'count': 1
+        }
+
+        item_counts = [0] * len(self._item_index)
+        for doc in self.db.items.find({}, projection):
+            if doc['item_index'] < len(self._item_index):
+                item_counts[doc['item_index']] = doc.get('count', 0)
+
+        return item_counts
+
+    item_info_projection = {
+        '_id': 0,
+        'itemId': 1,
+        'itemName': 1,
+        'item_index': 1,
+        'url': 1
+    }
+
+    def get_item_info(self, itemIds):
+
         item_infos = []
 
-        for doc in self.db.items.find({'itemId': {'$in': itemIds}}, projection):
+        for doc in self.db.items.find({'itemId': {'$in': itemIds}}, self.item_info_projection):
             item_infos.append(doc)
 
         return item_infos
@@ -125,16 +180,44 @@ class MongoClient(object):
         except Exception as e:
             print(e)
 
+    def get_item_lists(self, start, stop):
+        projection = {
+            '_id': 0,
+            'user_index': 1,
+            'sorted_items': 1
+        }
+
+        item_lists = dict()
+        for doc in self.db.users.find({'user_index': {'$gte': int(start), '$lt': int(stop)}}, projection):
+            item_lists[doc['user_index']] = doc['sorted_items']
+
+        return item_lists
+
+    def has_itemId(self, itemId):
+        return self._item_index.has_itemId(itemId)
+
     def get_index(self, itemId):
-        return self._itemId_to_index[itemId]
+        return self._item_index.get_index(itemId)
 
     def get_itemId(self, index):
-        return self._index_to_itemId[index]
+        return self._item_index.get_itemId(index)
 
     @property
     def total_items(self):
+        if self._total_items is None:
+            self._total_items = self.db.items.count()
+
+            if self._total_items < 0:
+                raise ValueError("Invalid database")
+
         return self._total_items
 
     @property
     def total_users(self):
+        if self._total_users is None:
+            self._total_users = self.db.users.count()
+
+            if self._total_users < 0:
+                raise ValueError("Invalid database")
+
         return self._total_users
\ No newline at end of file
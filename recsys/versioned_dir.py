@@ -0,0 +1,54 @@
+import os
+import time
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+CURRENT_FILENAME = 'CURRENT'
+LOCK_FILENAME = '.lock'
+
+
+def current_dir(root):
+    """ directory of the published version of root, None if nothing was published yet"""
+    current_path = os.path.join(root, CURRENT_FILENAME)
+    if not os.path.exists(current_path):
+        return None
+
+    with open(current_path, 'r') as f:
+        return os.path.join(root, f.read().strip())
+
+
+def new_version_dir(root):
+    """ an empty directory for the next version, readers do not see it before publish"""
+    version_dir = os.path.join(root, f'v{time.time_ns()}')
+    os.makedirs(version_dir)
+    return version_dir
+
+
+def publish(root, version_dir, num_kept_versions=2):
+    """ switch CURRENT to version_dir in one step and remove older versions
+
+    files of a removed version stay valid for processes that have them memory-mapped, so files that may be mapped
+    are never rewritten in place
+    """
+    current_path = os.path.join(root, CURRENT_FILENAME)
+    with open(current_path + '.tmp', 'w') as f:
+        f.write(os.path.basename(version_dir))
+    os.replace(current_path + '.tmp', current_path)
+
+    versions = sorted(name for name in os.listdir(root)
+                      if name.startswith('v') and os.path.isdir(os.path.join(root, name)))
+    for name in versions[:-num_kept_versions]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+@contextmanager
+def lock(root):
+    """ exclusive lock across processes, e.g. serving workers that would all rebuild the same artifact"""
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILENAME), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
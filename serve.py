@@ -1,15 +1,41 @@
 import os
-import numpy as np
-from flask import Flask, jsonify, request, send_from_directory
+import time
+from concurrent.futures import TimeoutError
+from flask import Flask, Response, jsonify, request, send_from_directory
 
 from recsys.ap_recsys import ApRecsys
+from recsys.index.ivf import IVFIndex
+from recsys.serve.metrics import Metrics
+from recsys.serve.micro_batcher import MicroBatcher
+from recsys.serve.model_holder import ModelHolder
 from recsys.serve.redis_client import RedisConnectionConfig, RedisClient
 from recsys.train.mongo_client import MongoConfig
 
 
-def get_api_server(ap_model, redis_client, top_k):
+def get_metric_gauges(model_holder):
+    """ scrape time gauges of /metrics: model version, reloads and cache hit rates"""
+    ap_model = model_holder.model
+    reload_stats = model_holder.stats()
+
+    gauges = [('model_info', {'model_version': ap_model.model_version}, 1),
+              ('model_reload_count', {}, reload_stats['reload_count']),
+              ('model_reloading', {}, int(reload_stats['reloading']))]
+
+    for cache, stats in [('recommendation', ap_model.recommendation_cache_stats()),
+                         ('item', ap_model.item_cache.stats())]:
+        if stats is not None:
+            gauges.append(('cache_hit_rate', {'cache': cache}, stats['hit_rate']))
+            gauges.append(('cache_size', {'cache': cache}, stats['size']))
+
+    return gauges
+
+
+def get_api_server(model_holder, redis_client, top_k, metrics=None, recommend_timeout_seconds=10):
     app = Flask(__name__, static_url_path='/static')
 
+    if metrics is None:
+        metrics = Metrics()
+
     version = 'v1.0'
 
     info = {
@@ -17,24 +43,103 @@ def get_api_server(ap_model, redis_client, top_k):
         'version': version
     }
 
+    def recommend_batch(index_seqs, ap_model=None):
+        # one model reference for the whole batch, a reload swap in between does not mix models
+        if ap_model is None:
+            with model_holder.use() as ap_model:
+                return recommend_batch(index_seqs, ap_model)
+
+        item_index, _ = ap_model.recommend(ap_model.get_serve_input(index_seqs), top_k)
+        return [(ap_model.to_itemId(row[row >= 0]), ap_model.model_version) for row in item_index]
+
+    # coalesces concurrent single-user requests into one model call, its thread starts in the serving process
+    batcher = MicroBatcher(recommend_batch, max_batch_size=64, max_wait_seconds=0.005)
+
+    def decode_history(input_itemId_seq):
+        return [itemId.decode("utf-8") for itemId in reversed(input_itemId_seq)]
+
+    def get_history(userId):
+        with metrics.time_stage('redis_fetch'):
+            return decode_history(redis_client[f'ap_mall_userId:{userId}'])
+
+    def json_response(response):
+        with metrics.time_stage('json_encoding'):
+            return jsonify(response)
+
+    def count_request(route, result, ap_model, status=200):
+        metrics.inc('requests_total', {'route': route, 'result': result, 'status': status,
+                                       'model_version': ap_model.model_version})
+
+    def get_precomputed_recommendation(ap_model, userId):
+        with metrics.time_stage('redis_fetch'):
+            recommendation_itemIds = redis_client.get_recommendations(f'ap_mall_rec:{userId}')
+
+        if len(recommendation_itemIds) == 0:
+            count_request('recommendation', 'no_history', ap_model)
+            response = {
+                'message': 'user history does not exist'
+            }
+
+            return json_response(response)
+
+        with metrics.time_stage('metadata_lookup'):
+            recommendation_items_info = ap_model.get_item_info(recommendation_itemIds)
+
+        count_request('recommendation', 'precomputed', ap_model)
+        response = {
+            'userId': userId,
+            'history_items_info': [],
+            'recommendation_items_info': recommendation_items_info,
+            'precomputed': True
+        }
+
+        return json_response(response)
+
+    def get_item_info_dict(ap_model, itemIds):
+        with metrics.time_stage('metadata_lookup'):
+            return {doc['itemId']: doc for doc in ap_model.get_item_info(list(set(itemIds)))}
+
     @app.route("/restore")
     def restore():
-        ap_model.restore(restore_serve=True)
-        return "restore"
+        # the new model is loaded and warmed up in the background, the live one keeps serving until the swap.
+        # only this worker reloads here, the others pick up newly published files through ModelHolder.watch
+        started = model_holder.reload()
+        return jsonify({'reload started': started,
+                        'model version': model_holder.model.model_version}), 202 if started else 409
 
     @app.route("/embedding")
     def embedding():
-        embeddings = ap_model.get_item_embeddings()
-        print('len: ', len(embeddings), 'embeddings size: ',len(embeddings[0]))
-        response = {
-            'embeddings': embeddings.tolist()
-        }
-
-        return jsonify(response)
+        # binary export streamed in chunks, ?start=&stop= select an item index range, ?itemIds=1 adds the itemIds
+        start = request.args.get('start', default=None, type=int)
+        stop = request.args.get('stop', default=None, type=int)
+        with_itemIds = request.args.get('itemIds', default=0, type=int) == 1
+
+        # the model stays open until the stream is closed, even if a reload swaps it out meanwhile
+        ap_model = model_holder.acquire()
+        try:
+            chunks = ap_model.iter_item_embeddings(start, stop, with_itemIds=with_itemIds)
+            response = Response(chunks, mimetype='application/octet-stream',
+                                headers={'X-Model-Version': str(ap_model.model_version)})
+        except Exception:
+            model_holder.release(ap_model)
+            raise
+
+        response.call_on_close(lambda: model_holder.release(ap_model))
+        return response
 
     @app.route("/info")
-    def info():
-        return jsonify({'server info': info})
+    def server_info():
+        ap_model = model_holder.model
+        return jsonify({'server info': info,
+                        'model version': ap_model.model_version,
+                        'model reload': model_holder.stats(),
+                        'recommendation cache': ap_model.recommendation_cache_stats(),
+                        'item cache': ap_model.item_cache.stats(),
+                        'latency': metrics.stats()})
+
+    @app.route("/metrics")
+    def get_metrics():
+        return Response(metrics.render(get_metric_gauges(model_holder)), mimetype='text/plain; version=0.0.4')
 
     @app.route('/')
     def root():
@@ -46,83 +151,203 @@ def get_api_server(ap_model, redis_client, top_k):
 
     @app.route('/recsys/api/', methods=['POST'])
     def get_personal_recommendation():
-        content = request.json
+        start = time.perf_counter()
+        try:
+            with model_holder.use() as ap_model:
+                return recommend_user(request.json, ap_model)
+        except Exception:
+            count_request('recommendation', 'error', model_holder.model, status=500)
+            raise
+        finally:
+            metrics.observe('request', time.perf_counter() - start)
+
+    def recommend_user(content, ap_model):
         userId = content['userId']
-        key = f'ap_mall_userId:{userId}'
-
-        print(key)
-
-        input_itemId_seq = redis_client[key]
-        input_itemId_seq.reverse()
-        input_itemId_seq = [itemId.decode("utf-8") for itemId in input_itemId_seq]
-
-        if len(input_itemId_seq) == 0:
-            response = {
-                'message': 'user history does not exist'
-            }
-
-            return jsonify(response)
 
-        input_index_seq = [ap_model.get_index(itemId) for itemId in input_itemId_seq]
-        pad_input_items = np.zeros(ap_model.max_seq_len, np.int32)
-        pad_input_items[:len(input_index_seq)] = input_index_seq
-        input = np.zeros(1, dtype=[('seq_item_id', (np.int32, ap_model.max_seq_len)), ('seq_len', np.int32)])
-        input[0] = (pad_input_items, len(input_index_seq))
-        user_embedding, logits = ap_model.serve(input)
+        # precomputed results from batch_inference.py, on request or when the live history has expired
+        if content.get('precomputed', False):
+            return get_precomputed_recommendation(ap_model, userId)
 
-        user_embedding = np.squeeze(user_embedding)
-        logit = np.squeeze(logits)
+        input_itemId_seq = get_history(userId)
 
-        # print('user_embedding: ', user_embedding)
+        # itemIds unknown to the model (e.g. new SKUs) are skipped
+        with metrics.time_stage('id_mapping'):
+            input_index_seq = ap_model.to_index(input_itemId_seq, unknown='skip')
 
-        #top K
-        item_index = np.argsort(logit)[::-1][:top_k]
+        if len(input_index_seq) == 0:
+            return get_precomputed_recommendation(ap_model, userId)
 
-        print('top K: ', item_index[:top_k])
-        print('logit: ', logit[:top_k])
+        # top K, including the wait for the micro-batch (model_call and top_k are timed inside)
+        try:
+            with metrics.time_stage('recommend'):
+                recommendation_itemIds, model_version = batcher(input_index_seq, timeout=recommend_timeout_seconds)
+        except TimeoutError:
+            count_request('recommendation', 'timeout', ap_model, status=503)
+            return jsonify({'message': 'recommendation timed out'}), 503
 
-        recommendation_itemIds = []
-        for index in item_index:
-            recommendation_itemIds.append(ap_model.get_itemId(index))
-
-
-        items_info = ap_model.get_item_info(input_itemId_seq)
-        recommendation_items_info = ap_model.get_item_info(recommendation_itemIds)
+        with metrics.time_stage('metadata_lookup'):
+            items_info = ap_model.get_item_info(input_itemId_seq)
+            recommendation_items_info = ap_model.get_item_info(recommendation_itemIds)
 
+        count_request('recommendation', 'live', ap_model)
         response = {
             'userId': userId,
             'history_items_info': items_info,
-            'recommendation_items_info': recommendation_items_info
+            'recommendation_items_info': recommendation_items_info,
+            'model_version': model_version
         }
-        for items in recommendation_items_info:
-            print(items["item_index"], items["itemName"])
 
-        return jsonify(response)
+        return json_response(response)
+
+    @app.route('/recsys/api/batch', methods=['POST'])
+    def get_personal_recommendations():
+        start = time.perf_counter()
+        try:
+            with model_holder.use() as ap_model:
+                return recommend_users(request.json, ap_model)
+        except Exception:
+            count_request('batch', 'error', model_holder.model, status=500)
+            raise
+        finally:
+            metrics.observe('batch_request', time.perf_counter() - start)
+
+    def recommend_users(content, ap_model):
+        userIds = content['userIds']
+
+        with metrics.time_stage('redis_fetch'):
+            histories = redis_client.mget_histories([f'ap_mall_userId:{userId}' for userId in userIds])
+        histories = [decode_history(history) for history in histories]
+
+        with metrics.time_stage('id_mapping'):
+            all_index_seqs = [ap_model.to_index(history, unknown='skip') for history in histories]
+
+        users = [(userId, history) for userId, history, index_seq in zip(userIds, histories, all_index_seqs)
+                 if len(index_seq) > 0]
+        index_seqs = [index_seq for index_seq in all_index_seqs if len(index_seq) > 0]
+        with metrics.time_stage('recommend'):
+            recommendations = recommend_batch(index_seqs, ap_model) if len(users) > 0 else []
+        recommendations = [itemIds for itemIds, _ in recommendations]
+
+        all_itemIds = [itemId for history in histories for itemId in history]
+        all_itemIds += [itemId for itemIds in recommendations for itemId in itemIds]
+        items_info = get_item_info_dict(ap_model, all_itemIds)
+
+        results = []
+        for (userId, history), recommendation_itemIds in zip(users, recommendations):
+            results.append({
+                'userId': userId,
+                'history_items_info': [items_info[itemId] for itemId in history if itemId in items_info],
+                'recommendation_items_info': [items_info[itemId] for itemId in recommendation_itemIds
+                                              if itemId in items_info]
+            })
+
+        count_request('batch', 'live', ap_model)
+        metrics.inc('batch_users_total', {'result': 'recommended'}, len(users))
+        metrics.inc('batch_users_total', {'result': 'missing'}, len(userIds) - len(users))
+
+        response = {
+            'results': results,
+            'missing_userIds': [userId for userId, index_seq in zip(userIds, all_index_seqs) if len(index_seq) == 0],
+            'model_version': ap_model.model_version
+        }
+
+        return json_response(response)
+
+    app.model_holder = model_holder
+    app.metrics = metrics
 
     return app
 
 
-def serve():
-    mongo_config = MongoConfig(host='13.209.6.203',
-                               username='romi',
-                               password="Amore12345!",
-                               dbname='recsys_apmall')
+def get_mongo_config():
+    return MongoConfig(host='13.209.6.203',
+                       username='romi',
+                       password="Amore12345!",
+                       dbname='recsys_apmall')
+
 
+def get_model_holder(top_k=20, intra_op_threads=None, inter_op_threads=None, metrics=None):
+    mongo_config = get_mongo_config()
     model_save_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_save')
 
-    ap_model = ApRecsys(model_save_path, mongo_config)
-    ap_model.build_serve_model()
-    ap_model.restore(restore_serve=True)
+    def load_checkpoint(ap_model):
+        ap_model.build_serve_model()
+        ap_model.restore(restore_serve=True)
+        ap_model.build_index(IVFIndex())
+
+    def load_model(current_model):
+        if current_model is None:
+            ap_model = ApRecsys(model_save_path, mongo_config)
+            ap_model.intra_op_threads = intra_op_threads
+            ap_model.inter_op_threads = inter_op_threads
+        else:
+            # reuse the mongodb connection and caches, only the serving model is new
+            ap_model = current_model.new_serve_replica()
+
+        if ap_model.has_item_embedding_store(with_user_tower=True):
+            # quantized item embeddings and the user tower published with them, never a separately exported tower
+            ap_model.load_item_embedding_store(with_user_tower=True)
+        elif ap_model.has_exported_serve_model():
+            ap_model.load_serve_model()
+            ap_model.build_index(IVFIndex())
+        else:
+            load_checkpoint(ap_model)
+            return ap_model
+
+        if not ap_model.serves_all_items() and ap_model.has_checkpoint():
+            # items were ingested after the export, the checkpoint restore grows the item tables to the item index
+            print(f'exported model knows {ap_model.serve_total_items} of {ap_model.total_items} items, '
+                  f'serving from the checkpoint')
+            ap_model.close_serve_session()
+            ap_model = ap_model.new_serve_replica()
+            load_checkpoint(ap_model)
+
+        return ap_model
+
+    def warm_up(ap_model):
+        # first session runs are slow, run them before the model takes traffic
+        ap_model.recommend(ap_model.get_serve_input([[0]] * 8), top_k=top_k)
+        ap_model.enable_recommendation_cache()
+        ap_model.metrics = metrics
+
+    def close_model(ap_model):
+        ap_model.close_serve_session()
+
+    def get_version(ap_model):
+        return ap_model.serve_files_version()
+
+    return ModelHolder(load_model, warm_up=warm_up, close_model=close_model, get_version=get_version)
+
+
+def create_app(preload=False, top_k=20, max_seq_len=ApRecsys.default_max_seq_len, intra_op_threads=None,
+               inter_op_threads=None):
+    """ api app for a WSGI server
+
+    with preload the model is not loaded here: tensorflow sessions do not survive a fork, so every worker calls
+    app.model_holder.load() after forking (see gunicorn.conf.py). max_seq_len is then the history length read
+    from redis, otherwise it is taken from the loaded model.
+    """
+    metrics = Metrics()
+    model_holder = get_model_holder(top_k=top_k, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                                    metrics=metrics)
+    if not preload:
+        max_seq_len = model_holder.load().max_seq_len
+        model_holder.watch()
 
     redis_config = RedisConnectionConfig()
     redis_client = RedisClient(redis_connection_config=redis_config,
-                               max_seq_len=ap_model.max_seq_len,
+                               max_seq_len=max_seq_len,
                                expire_time_seconds=None)
 
+    return get_api_server(model_holder, redis_client, top_k=top_k, metrics=metrics)
+
+
+def serve():
+    """ development server, use gunicorn -c gunicorn.conf.py wsgi:app in production"""
     # WAS
-    api_server = get_api_server(ap_model, redis_client, top_k=20)
-    api_server.run(host='0.0.0.0', debug=True)
+    api_server = create_app()
+    api_server.run(host='0.0.0.0', debug=False, threaded=True)
 
 
 if __name__ == '__main__':
-    serve()
\ No newline at end of file
+    serve()
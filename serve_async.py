@@ -0,0 +1,312 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from recsys.serve.async_redis_client import AsyncRedisClient
+from recsys.serve.metrics import Metrics
+from recsys.serve.micro_batcher import MicroBatcher
+from recsys.serve.redis_client import RedisConnectionConfig
+from recsys.train.mongo_client import MongoClient
+from serve import get_metric_gauges, get_model_holder, get_mongo_config
+
+
+def get_async_api_server(model_holder, redis_client, item_collection, top_k, model_threads=4,
+                         max_pending_model_calls=64, metrics=None, recommend_timeout_seconds=10):
+    """ asyncio variant of serve.get_api_server
+
+    redis and mongodb are awaited on the event loop; model calls run on a bounded thread pool (the micro-batcher
+    thread for single users), and at most max_pending_model_calls of them wait there at a time.
+    """
+    app = web.Application()
+
+    if metrics is None:
+        metrics = Metrics()
+
+    version = 'v1.0'
+
+    info = {
+        'name': 'ap recsys api (asyncio)',
+        'version': version
+    }
+
+    model_executor = ThreadPoolExecutor(max_workers=model_threads, thread_name_prefix='model')
+    # created on startup, on the loop that runs the app
+    model_calls = None
+
+    def recommend_batch(index_seqs, ap_model=None):
+        if ap_model is None:
+            with model_holder.use() as ap_model:
+                return recommend_batch(index_seqs, ap_model)
+
+        item_index, _ = ap_model.recommend(ap_model.get_serve_input(index_seqs), top_k)
+        return [(ap_model.to_itemId(row[row >= 0]), ap_model.model_version) for row in item_index]
+
+    batcher = MicroBatcher(recommend_batch, max_batch_size=64, max_wait_seconds=0.005)
+
+    # model stages are timed off the event loop. redis_fetch and metadata_lookup time awaited calls, so they also
+    # include the time the loop spends on other requests before resuming this one
+
+    async def recommend_one(index_seq):
+        async with model_calls:
+            submitted = time.perf_counter()
+            future = batcher.submit(index_seq)
+            # runs on the batcher thread when the result is set
+            future.add_done_callback(lambda _: metrics.observe('recommend', time.perf_counter() - submitted))
+            return await asyncio.wait_for(asyncio.wrap_future(future), recommend_timeout_seconds)
+
+    def run_model_call(ap_model, fn, *args):
+        # the call holds ap_model itself: a cancelled request must not let a reload close it under a running call
+        model_holder.acquire(ap_model)
+        try:
+            future = model_executor.submit(fn, *args)
+        except Exception:
+            model_holder.release(ap_model)
+            raise
+
+        future.add_done_callback(lambda _: model_holder.release(ap_model))
+        return asyncio.wrap_future(future)
+
+    def timed_recommend_batch(index_seqs, ap_model):
+        with metrics.time_stage('recommend'):
+            return recommend_batch(index_seqs, ap_model)
+
+    async def recommend_many(index_seqs, ap_model):
+        async with model_calls:
+            return await run_model_call(ap_model, timed_recommend_batch, index_seqs, ap_model)
+
+    def decode_history(input_itemId_seq):
+        return [itemId.decode("utf-8") for itemId in reversed(input_itemId_seq)]
+
+    async def get_item_info(ap_model, itemIds):
+        # the item cache is in memory, only its misses go to mongodb
+        itemIds, item_infos, missing = ap_model.item_cache.lookup(itemIds)
+
+        if len(missing) > 0:
+            cursor = item_collection.find({'itemId': {'$in': missing}}, MongoClient.item_info_projection)
+            ap_model.item_cache.add_fetched(item_infos, await cursor.to_list(length=None))
+
+        return [item_infos[itemId] for itemId in itemIds if itemId in item_infos]
+
+    def json_response(response):
+        with metrics.time_stage('json_encoding'):
+            return web.json_response(response)
+
+    def count_request(route, result, ap_model, status=200):
+        metrics.inc('requests_total', {'route': route, 'result': result, 'status': status,
+                                       'model_version': ap_model.model_version})
+
+    async def get_precomputed_recommendation(ap_model, userId):
+        with metrics.time_stage('redis_fetch'):
+            recommendation_itemIds = await redis_client.get_recommendations(f'ap_mall_rec:{userId}')
+
+        if len(recommendation_itemIds) == 0:
+            count_request('recommendation', 'no_history', ap_model)
+            return json_response({'message': 'user history does not exist'})
+
+        with metrics.time_stage('metadata_lookup'):
+            recommendation_items_info = await get_item_info(ap_model, recommendation_itemIds)
+
+        count_request('recommendation', 'precomputed', ap_model)
+        response = {
+            'userId': userId,
+            'history_items_info': [],
+            'recommendation_items_info': recommendation_items_info,
+            'precomputed': True
+        }
+
+        return json_response(response)
+
+    async def restore(request):
+        started = model_holder.reload()
+        return web.json_response({'reload started': started,
+                                  'model version': model_holder.model.model_version},
+                                 status=202 if started else 409)
+
+    async def embedding(request):
+        # same binary export as serve.py, every chunk is read from the model on the executor
+        start = request.query.get('start')
+        stop = request.query.get('stop')
+        with_itemIds = request.query.get('itemIds', '0') == '1'
+
+        with model_holder.use() as ap_model:
+            chunks = ap_model.iter_item_embeddings(None if start is None else int(start),
+                                                   None if stop is None else int(stop),
+                                                   with_itemIds=with_itemIds)
+
+            response = web.StreamResponse(headers={'Content-Type': 'application/octet-stream',
+                                                   'X-Model-Version': str(ap_model.model_version)})
+            await response.prepare(request)
+
+            while True:
+                chunk = await run_model_call(ap_model, next, chunks, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+
+            await response.write_eof()
+            return response
+
+    async def server_info(request):
+        ap_model = model_holder.model
+        return web.json_response({'server info': info,
+                                  'model version': ap_model.model_version,
+                                  'model reload': model_holder.stats(),
+                                  'recommendation cache': ap_model.recommendation_cache_stats(),
+                                  'item cache': ap_model.item_cache.stats(),
+                                  'latency': metrics.stats()})
+
+    async def get_metrics(request):
+        return web.Response(text=metrics.render(get_metric_gauges(model_holder)), content_type='text/plain')
+
+    async def get_personal_recommendation(request):
+        start = time.perf_counter()
+        try:
+            with model_holder.use() as ap_model:
+                return await recommend_user(await request.json(), ap_model)
+        except Exception:
+            count_request('recommendation', 'error', model_holder.model, status=500)
+            raise
+        finally:
+            metrics.observe('request', time.perf_counter() - start)
+
+    async def recommend_user(content, ap_model):
+        userId = content['userId']
+
+        if content.get('precomputed', False):
+            return await get_precomputed_recommendation(ap_model, userId)
+
+        with metrics.time_stage('redis_fetch'):
+            input_itemId_seq = decode_history(await redis_client.get_history(f'ap_mall_userId:{userId}'))
+
+        with metrics.time_stage('id_mapping'):
+            input_index_seq = ap_model.to_index(input_itemId_seq, unknown='skip')
+
+        if len(input_index_seq) == 0:
+            return await get_precomputed_recommendation(ap_model, userId)
+
+        try:
+            recommendation_itemIds, model_version = await recommend_one(input_index_seq)
+        except asyncio.TimeoutError:
+            count_request('recommendation', 'timeout', ap_model, status=503)
+            return web.json_response({'message': 'recommendation timed out'}, status=503)
+
+        with metrics.time_stage('metadata_lookup'):
+            items_info, recommendation_items_info = await asyncio.gather(
+                get_item_info(ap_model, input_itemId_seq),
+                get_item_info(ap_model, recommendation_itemIds))
+
+        count_request('recommendation', 'live', ap_model)
+        response = {
+            'userId': userId,
+            'history_items_info': items_info,
+            'recommendation_items_info': recommendation_items_info,
+            'model_version': model_version
+        }
+
+        return json_response(response)
+
+    async def get_personal_recommendations(request):
+        start = time.perf_counter()
+        try:
+            with model_holder.use() as ap_model:
+                return await recommend_users(await request.json(), ap_model)
+        except Exception:
+            count_request('batch', 'error', model_holder.model, status=500)
+            raise
+        finally:
+            metrics.observe('batch_request', time.perf_counter() - start)
+
+    async def recommend_users(content, ap_model):
+        userIds = content['userIds']
+
+        with metrics.time_stage('redis_fetch'):
+            histories = await redis_client.mget_histories([f'ap_mall_userId:{userId}' for userId in userIds])
+        histories = [decode_history(history) for history in histories]
+
+        with metrics.time_stage('id_mapping'):
+            all_index_seqs = [ap_model.to_index(history, unknown='skip') for history in histories]
+
+        users = [(userId, history) for userId, history, index_seq in zip(userIds, histories, all_index_seqs)
+                 if len(index_seq) > 0]
+        index_seqs = [index_seq for index_seq in all_index_seqs if len(index_seq) > 0]
+        recommendations = await recommend_many(index_seqs, ap_model) if len(users) > 0 else []
+        recommendations = [itemIds for itemIds, _ in recommendations]
+
+        all_itemIds = [itemId for history in histories for itemId in history]
+        all_itemIds += [itemId for itemIds in recommendations for itemId in itemIds]
+        with metrics.time_stage('metadata_lookup'):
+            items_info = {doc['itemId']: doc for doc in await get_item_info(ap_model, all_itemIds)}
+
+        results = []
+        for (userId, history), recommendation_itemIds in zip(users, recommendations):
+            results.append({
+                'userId': userId,
+                'history_items_info': [items_info[itemId] for itemId in history if itemId in items_info],
+                'recommendation_items_info': [items_info[itemId] for itemId in recommendation_itemIds
+                                              if itemId in items_info]
+            })
+
+        count_request('batch', 'live', ap_model)
+        metrics.inc('batch_users_total', {'result': 'recommended'}, len(users))
+        metrics.inc('batch_users_total', {'result': 'missing'}, len(userIds) - len(users))
+
+        response = {
+            'results': results,
+            'missing_userIds': [userId for userId, index_seq in zip(userIds, all_index_seqs) if len(index_seq) == 0],
+            'model_version': ap_model.model_version
+        }
+
+        return json_response(response)
+
+    async def on_startup(app):
+        nonlocal model_calls
+        model_calls = asyncio.Semaphore(max_pending_model_calls)
+
+    async def on_cleanup(app):
+        batcher.close()
+        model_executor.shutdown(wait=False)
+        await redis_client.close()
+
+    app.router.add_get('/restore', restore)
+    app.router.add_get('/embedding', embedding)
+    app.router.add_get('/info', server_info)
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_post('/recsys/api/', get_personal_recommendation)
+    app.router.add_post('/recsys/api/batch', get_personal_recommendations)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+
+    app.model_holder = model_holder
+    app.metrics = metrics
+
+    return app
+
+
+def serve_async(host='0.0.0.0', port=5000, top_k=20, model_threads=4, intra_op_threads=None, inter_op_threads=None):
+    metrics = Metrics()
+    model_holder = get_model_holder(top_k=top_k, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                                    metrics=metrics)
+    ap_model = model_holder.load()
+    model_holder.watch()
+
+    redis_client = AsyncRedisClient(redis_connection_config=RedisConnectionConfig(),
+                                    max_seq_len=ap_model.max_seq_len,
+                                    expire_time_seconds=None)
+
+    mongo_config = get_mongo_config()
+    mongo = AsyncIOMotorClient(host=mongo_config.host,
+                               username=mongo_config.username,
+                               password=mongo_config.password,
+                               authSource='admin',
+                               authMechanism='SCRAM-SHA-256')
+
+    api_server = get_async_api_server(model_holder, redis_client, mongo[mongo_config.dbname].items, top_k=top_k,
+                                      model_threads=model_threads, metrics=metrics)
+    web.run_app(api_server, host=host, port=port)
+
+
+if __name__ == '__main__':
+    serve_async()
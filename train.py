@@ -24,11 +24,13 @@ def train():
     model_save_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_save')
 
     ap_recsys = ApRecsys(model_save_path, mongo_config)
+    ap_recsys.use_history_store()
+    ap_recsys.num_sampled = 1000
 
-    train_sampler = ap_recsys.get_train_sampler()
+    train_sampler = ap_recsys.get_train_sampler(shared_memory=True)
     eval_sampler = ap_recsys.get_eval_sampler()
 
-    ap_recsys.build_train_model()
+    ap_recsys.build_train_model(train_sampler=train_sampler)
     ap_recsys.build_serve_model()
 
     ap_recsys.add_evaluator(Precision(precision_at=[100]))
@@ -37,12 +39,12 @@ def train():
 
     acc_loss = 0
     min_loss = None
+    best_auc = None
     total_iter = 0
     while True:
         summary = tf.Summary()
 
-        batch_data = train_sampler.next_batch()
-        loss = ap_recsys.train(total_iter, batch_data)
+        loss = ap_recsys.train(total_iter)
         if min_loss is None:
             min_loss = loss
             acc_loss = loss
@@ -61,6 +63,8 @@ def train():
             summary.value.add(tag='avg_loss', simple_value=avg_loss)
             acc_loss = 0
 
+            ap_recsys.save()
+            ap_recsys.sync_serve_model()
             eval_results = ap_recsys.evaluate(eval_sampler=eval_sampler, step=total_iter)
             eval_results = dict(eval_results)
 
@@ -73,6 +77,14 @@ def train():
             summary.value.add(tag='AUC', simple_value=np.mean(eval_results['AUC']))
             summary.value.add(tag='rank_above', simple_value=np.mean(eval_results['rank_above']))
 
+            # serving artifacts only for the best model so far, exporting them is not free
+            auc = np.mean(eval_results['AUC'])
+            if best_auc is None or auc > best_auc:
+                best_auc = auc
+                ap_recsys.export_serve_model()
+                # the user tower is published together with the store
+                ap_recsys.export_item_embedding_store()
+
             # save item embedding
             # item_embeddings = ap_recsys.get_item_embeddings()
 
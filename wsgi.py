@@ -0,0 +1,9 @@
+import os
+
+from serve import create_app
+
+# loaded once by the gunicorn master (preload_app), the model itself is loaded in every worker after fork
+app = create_app(preload=True,
+                 top_k=int(os.environ.get('RECSYS_TOP_K', 20)),
+                 intra_op_threads=int(os.environ.get('RECSYS_INTRA_OP_THREADS', 0)) or None,
+                 inter_op_threads=int(os.environ.get('RECSYS_INTER_OP_THREADS', 0)) or None)